@@ -0,0 +1,98 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+#
+# "resource budget"
+# Runs a shell command in its own process group and kills the whole group
+# as soon as it exceeds one of its budgets:
+#   --rss  summed resident set size of the process tree in MiB
+#   --cpu  summed user+sys CPU time of the process tree in seconds
+#   --wall wall time in seconds
+# The peak usage (and the exceeded budget if any) is written to a JSON
+# record, the exit status is the one of the command or 124 if it was killed.
+# Processes running as another user (e.g. through sudo) are measured too,
+# sudo relays the SIGTERM to them.
+#
+# Usage: $ python budget-run.py [--rss MIB] [--cpu SEC] [--wall SEC] \
+#            [--record PATH] -- 'cd file-metadata/ && python -m pytest'
+#
+# See also: tasks.py, process_tree.py
+#
+
+from __future__ import (division, absolute_import, unicode_literals,
+                        print_function)
+
+import argparse
+import json
+import os
+import resource
+import signal
+import subprocess
+import sys
+import time
+
+import process_tree
+
+EXCEEDED = 124                          # like timeout(1)
+
+
+def kill(proc):
+    for sig in (signal.SIGTERM, signal.SIGKILL):
+        try:
+            os.killpg(proc.pid, sig)
+        except OSError:                 # gone (or not allowed to)
+            pass
+        deadline = time.time() + 5
+        while proc.poll() is None and time.time() < deadline:
+            time.sleep(0.1)
+        if proc.poll() is not None:
+            return
+
+
+def main(args):
+    parser = argparse.ArgumentParser(description="resource budget")
+    parser.add_argument('--rss', type=float, help="RSS budget in MiB")
+    parser.add_argument('--cpu', type=float, help="CPU budget in seconds")
+    parser.add_argument('--wall', type=float, help="wall budget in seconds")
+    parser.add_argument('--interval', type=float, default=0.2,
+                        help="sampling interval in seconds")
+    parser.add_argument('--record', help="JSON record of the usage")
+    parser.add_argument('command', help="shell command to run")
+    opts = parser.parse_args(args)
+    budget = dict((k, getattr(opts, k)) for k in ('rss', 'cpu', 'wall')
+                  if getattr(opts, k) is not None)
+    record = {'budget': budget, 'usage': {'rss': 0, 'cpu': 0, 'wall': 0},
+              'exceeded': None}
+    start = time.time()
+    proc = subprocess.Popen(['/bin/bash', '-c', opts.command],
+                            preexec_fn=os.setsid)
+    while proc.poll() is None:
+        (rss, cpu) = process_tree.usage(proc.pid)
+        peak = record['usage']
+        peak['rss'], peak['cpu'] = max(peak['rss'], rss), max(peak['cpu'], cpu)
+        peak['wall'] = time.time() - start
+        over = [k for k in sorted(budget) if peak[k] > budget[k]]
+        if over:
+            record['exceeded'] = over[0]
+            sys.stderr.write("budget-run: exceeded {0!s} budget ({1:.1f} > "
+                             "{2:.1f}), killing {3!s}\n".format(
+                                 over[0], peak[over[0]], budget[over[0]],
+                                 opts.command))
+            kill(proc)
+            break
+        time.sleep(opts.interval)
+    proc.wait()
+    children = resource.getrusage(resource.RUSAGE_CHILDREN)
+    record['usage']['wall'] = time.time() - start
+    record['usage']['cpu'] = max(record['usage']['cpu'],
+                                 children.ru_utime + children.ru_stime)
+    record['exit'] = proc.returncode
+    if opts.record:
+        with open(opts.record, 'w') as f:
+            json.dump(record, f, indent=4, sort_keys=True)
+    if record['exceeded']:
+        return EXCEEDED
+    return proc.returncode if proc.returncode >= 0 else 128 - proc.returncode
+
+
+if __name__ == '__main__':
+    sys.exit(main(sys.argv[1:]))
@@ -0,0 +1,315 @@
+# -*- coding: utf-8 -*-
+#
+# "asynchronous error reporting"
+# Sends the failure records parsed from the step output (see tasks.py) to
+# error tracking sinks while the following steps run: every sink has a
+# thread of its own collecting the records into batches (up to BATCH
+# records or BATCH_WAIT seconds) and delivering them with a timeout and
+# retries, so a slow or unreachable endpoint delays neither the steps nor
+# the other sinks. Sinks:
+#   Termbin  pastes a batch (and whole step logs) to termbin.com over TCP
+#   Rollbar  posts every record as an item to the rollbar API over HTTP
+#
+# Usage: (tasks.py)
+#          reporter = error_report.Reporter(error_report.sinks('test'))
+#          reporter(record, step=cmd, task=name)
+#          reporter.attach('out.log.gz', step=cmd, task=name)
+#          reporter.close(timeout=60)
+#        (local stand-in sinks printing what they receive, use with
+#         TASKS_TERMBIN=localhost:9999 TASKS_ROLLBAR=http://localhost:8098/)
+#        $ python error_report.py --termbin 9999 --rollbar 8098
+#
+# See also: tasks.py, mock-wiki.py
+#
+
+from __future__ import (division, absolute_import, unicode_literals,
+                        print_function)
+
+import argparse
+import gzip
+import json
+import logging
+import os
+import socket
+import sys
+import threading
+import time
+
+try:
+    import queue
+    from urllib.request import Request, urlopen
+    from http.server import BaseHTTPRequestHandler, HTTPServer
+    from socketserver import StreamRequestHandler, ThreadingMixIn, TCPServer
+except ImportError:         # python 2
+    import Queue as queue
+    from urllib2 import Request, urlopen
+    from BaseHTTPServer import BaseHTTPRequestHandler, HTTPServer
+    from SocketServer import StreamRequestHandler, ThreadingMixIn, TCPServer
+
+# endpoints, set them in the environment to use local stand-ins
+TERMBIN = 'termbin.com:9999'
+ROLLBAR = 'https://api.rollbar.com/api/1/item/'
+ROLLBAR_TOKEN = 'cfde394e4c534722a0e55de1ef435190'
+BATCH = 50
+BATCH_WAIT = 2.0            # seconds
+TIMEOUT = 10.0              # seconds per attempt
+RETRIES = 3                 # attempts per batch, with exponential backoff
+BACKOFF = 1.0               # seconds before the second attempt
+
+
+# Text of a failure record as pasted or sent
+def text(record):
+    head = " / ".join(record[key] for key in ('task', 'step', 'title')
+                      if record.get(key))
+    lines = record.get('lines', [])
+    if record.get('truncated'):
+        lines = lines + ["... ({0:d} lines truncated)".format(
+            record['truncated'])]
+    return "\n".join([head] + lines) + "\n"
+
+
+# Sink pasting every batch of failure records (and every attached log) to
+# termbin.com (or a compatible netcat pastebin), returns the paste URLs
+class Termbin(object):
+    name = 'termbin'
+    skips = ()                  # kinds of records not sent
+
+    def __init__(self, address=TERMBIN, timeout=TIMEOUT):
+        host, port = address.rsplit(':', 1)
+        self.address = (host, int(port))
+        self.timeout = timeout
+
+    def paste(self, data):
+        conn = socket.create_connection(self.address, self.timeout)
+        try:
+            conn.sendall(data)
+            conn.shutdown(socket.SHUT_WR)
+            reply = b""
+            while True:
+                chunk = conn.recv(4096)
+                if not chunk:
+                    break
+                reply += chunk
+        finally:
+            conn.close()
+        url = reply.decode('utf-8', 'replace').strip('\x00\r\n ')
+        if not url:
+            raise IOError("no paste URL from {0!s}:{1:d}".format(
+                *self.address))
+        return url
+
+    # (the delivered records are removed from the batch, a retry sends the
+    # rest)
+    def send(self, batch):
+        urls = []
+        failures = [r for r in batch if r['kind'] != 'log']
+        if failures:
+            urls.append(self.paste("\f\n".join(
+                text(record) for record in failures).encode('utf-8')))
+            batch[:] = [r for r in batch if r['kind'] == 'log']
+        while batch:
+            with gzip.open(batch[0]['path'], 'rb') as f:
+                urls.append(self.paste(f.read()))
+            batch.pop(0)
+        return urls
+
+
+# Sink posting every failure record as an item to the rollbar API (there
+# is no batch endpoint), attached logs are not sent
+class Rollbar(object):
+    name = 'rollbar'
+    skips = ('log',)
+
+    def __init__(self, environment, url=ROLLBAR, token=ROLLBAR_TOKEN,
+                 timeout=TIMEOUT):
+        self.environment = environment
+        self.url = url
+        self.token = token
+        self.timeout = timeout
+
+    def item(self, record):
+        return {'access_token': self.token, 'data': {
+            'environment': self.environment, 'level': 'error',
+            'title': record['title'][:255], 'platform': sys.platform,
+            'body': {'message': {'body': text(record)}},
+            'custom': {'kind': record['kind'], 'step': record.get('step'),
+                       'task': record.get('task')}}}
+
+    def send(self, batch):
+        uuids = []
+        while batch:
+            request = Request(self.url, json.dumps(
+                self.item(batch[0])).encode('utf-8'),
+                {'Content-Type': 'application/json'})
+            reply = json.loads(urlopen(request, timeout=self.timeout)
+                               .read().decode('utf-8'))
+            if reply.get('err'):
+                raise IOError("rollbar: {0!s}".format(reply.get('message')))
+            uuids.append(reply.get('result', {}).get('uuid'))
+            batch.pop(0)
+        return uuids
+
+
+# The sinks for the rollbar 'environment' (endpoints from the environment)
+def sinks(environment, environ=None):
+    environ = os.environ if environ is None else environ
+    return [Termbin(environ.get('TASKS_TERMBIN', TERMBIN)),
+            Rollbar(environment, environ.get('TASKS_ROLLBAR', ROLLBAR))]
+
+
+# Thread delivering the records queued for one sink in batches
+class Sender(threading.Thread):
+    def __init__(self, sink, batch=BATCH, wait=BATCH_WAIT, retries=RETRIES):
+        super(Sender, self).__init__(name="error_report-{0!s}".format(
+            sink.name))
+        self.daemon = True
+        self.sink = sink
+        self.batch = batch
+        self.wait = wait
+        self.retries = retries
+        self.queue = queue.Queue()
+        self.sent = self.failed = self.batches = 0
+        self.results = []
+
+    def run(self):
+        done = False
+        while not done:
+            batch = [self.queue.get()]
+            done = batch[0] is None
+            deadline = time.time() + self.wait
+            while not done and len(batch) < self.batch:
+                try:
+                    batch.append(self.queue.get(
+                        timeout=max(deadline - time.time(), 0)))
+                except queue.Empty:
+                    break
+                done = batch[-1] is None
+            batch = [record for record in batch if record is not None]
+            if batch:
+                self.deliver(batch)
+
+    # (records of kinds the sink skips are neither sent nor counted)
+    def deliver(self, batch):
+        batch = [r for r in batch if r['kind'] not in self.sink.skips]
+        if not batch:
+            return
+        self.batches += 1
+        size = len(batch)
+        for attempt in range(self.retries):
+            try:
+                self.results.extend(self.sink.send(batch))
+                self.sent += size
+                return
+            except (socket.error, IOError, OSError, ValueError) as e:
+                logging.warning("error_report: {0!s} attempt {1:d} failed: "
+                                "{2!s}".format(self.sink.name, attempt + 1, e))
+                if attempt + 1 < self.retries:
+                    time.sleep(BACKOFF * 2 ** attempt)
+        self.sent += size - len(batch)
+        self.failed += len(batch)
+
+
+# Reporter (a handler of the failure records) fanning the records out to
+# the senders of all sinks
+class Reporter(object):
+    def __init__(self, sinks, batch=BATCH, wait=BATCH_WAIT, retries=RETRIES):
+        self.senders = [Sender(sink, batch, wait, retries) for sink in sinks]
+        for sender in self.senders:
+            sender.start()
+
+    def __call__(self, record, **context):
+        entry = dict(record, **context)
+        for sender in self.senders:
+            sender.queue.put(entry)
+
+    # Send the (closed) gzip compressed log file of a step too
+    def attach(self, path, **context):
+        self.__call__({'kind': 'log', 'title': path, 'path': path,
+                       'lines': []}, **context)
+
+    # Send what is queued and wait up to 'timeout' seconds for the senders,
+    # returns the summary of every sink
+    def close(self, timeout=60.0):
+        for sender in self.senders:
+            sender.queue.put(None)
+        deadline = time.time() + timeout
+        summary = []
+        for sender in self.senders:
+            sender.join(max(deadline - time.time(), 0))
+            summary.append({'sink': sender.sink.name, 'sent': sender.sent,
+                            'failed': sender.failed,
+                            'batches': sender.batches,
+                            'pending': sender.queue.qsize(),
+                            'results': sender.results})
+        return summary
+
+
+class ThreadingTCPServer(ThreadingMixIn, TCPServer):
+    daemon_threads = True
+    allow_reuse_address = True
+
+
+class ThreadingHTTPServer(ThreadingMixIn, HTTPServer):
+    daemon_threads = True
+
+
+# Stand-in for termbin: prints the paste, answers with a paste URL
+class PasteHandler(StreamRequestHandler):
+    def handle(self):
+        data = self.rfile.read()
+        self.server.count += 1
+        sys.stdout.write("--- paste {0:d} ({1:d} bytes)\n{2!s}\n".format(
+            self.server.count, len(data), data.decode('utf-8', 'replace')))
+        sys.stdout.flush()
+        self.wfile.write("http://localhost/{0:d}\n".format(
+            self.server.count).encode('utf-8'))
+
+
+# Stand-in for the rollbar item API: prints the item, answers with a uuid
+class ItemHandler(BaseHTTPRequestHandler):
+    def do_POST(self):
+        data = self.rfile.read(int(self.headers.get('Content-Length', 0)))
+        self.server.count += 1
+        item = json.loads(data.decode('utf-8'))
+        sys.stdout.write("--- item {0:d} ({1!s})\n{2!s}\n".format(
+            self.server.count, item['data']['environment'],
+            item['data']['body']['message']['body']))
+        sys.stdout.flush()
+        body = json.dumps({'err': 0, 'result': {
+            'uuid': "{0:032d}".format(self.server.count)}}).encode('utf-8')
+        self.send_response(200)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        pass
+
+
+def main(args):
+    parser = argparse.ArgumentParser(description="local stand-in error "
+                                                 "sinks")
+    parser.add_argument('--termbin', type=int, default=9999,
+                        help="TCP port of the paste sink")
+    parser.add_argument('--rollbar', type=int, default=8098,
+                        help="HTTP port of the item sink")
+    opts = parser.parse_args(args)
+    servers = [ThreadingTCPServer(('localhost', opts.termbin), PasteHandler),
+               ThreadingHTTPServer(('localhost', opts.rollbar), ItemHandler)]
+    for server in servers:
+        server.count = 0
+        thread = threading.Thread(target=server.serve_forever)
+        thread.daemon = True
+        thread.start()
+    sys.stderr.write("error_report: serving pastes on port {0:d}, items on "
+                     "port {1:d}\n".format(opts.termbin, opts.rollbar))
+    try:
+        while True:
+            time.sleep(3600)
+    except KeyboardInterrupt:
+        return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main(sys.argv[1:]))
@@ -0,0 +1,176 @@
+# -*- coding: utf-8 -*-
+#
+# "non-blocking logging"
+# Logging through a bounded queue: the handlers (formatting, writing and
+# rotation) run on a background thread, the logging calls only enqueue the
+# records. If the queue is full the record is dropped ('drop') or the
+# caller waits up to 'timeout' seconds for space before dropping it
+# ('block', back-pressure). Dropped records and the latency from the
+# logging call until the record is handled are counted and reported to
+# stderr at exit (if anything was logged).
+#
+# Usage: (tasks.py, the handlers of a logger)
+#          log_queue.install(logging.getLogger(), policy='block')
+#        (user-config.py, the file handlers pywikibot adds later)
+#          log_queue.patch(policy='drop')
+#
+# See also: tasks.py, mock-wiki.py
+#
+
+from __future__ import (division, absolute_import, unicode_literals,
+                        print_function)
+
+import atexit
+import logging
+import sys
+import threading
+import time
+
+try:
+    import queue
+except ImportError:         # python 2
+    import Queue as queue
+
+CAPACITY = 10000
+POLICIES = ('drop', 'block')
+
+
+# Counters of a queue, updated by the callers and the listener
+class Stats(object):
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.queued = 0
+        self.dropped = 0
+        self.handled = 0
+        self.latency = 0.0          # sum, in seconds
+        self.slowest = 0.0
+
+    def report(self, name):
+        with self.lock:
+            return ("{0!s}: {1:d} records, {2:d} dropped, latency avg "
+                    "{3:.2f}ms max {4:.2f}ms\n".format(
+                        name, self.queued + self.dropped, self.dropped,
+                        1000 * self.latency / (self.handled or 1),
+                        1000 * self.slowest))
+
+
+# Bounded queue of (handlers, record) and the thread handling them
+class Listener(threading.Thread):
+    def __init__(self, capacity=CAPACITY, policy='drop', timeout=0.1):
+        super(Listener, self).__init__(name='log_queue')
+        if policy not in POLICIES:
+            raise ValueError("Unknown policy {0!s}, use one of {1!s}".format(
+                policy, ", ".join(POLICIES)))
+        self.daemon = True
+        self.handlers = set()       # all handlers behind the queue
+        self.queue = queue.Queue(capacity)
+        self.policy = policy
+        self.timeout = timeout
+        self.stats = Stats()
+
+    def put(self, handlers, record):
+        try:
+            if self.policy == 'block':
+                self.queue.put((handlers, record), timeout=self.timeout)
+            else:
+                self.queue.put_nowait((handlers, record))
+        except queue.Full:
+            with self.stats.lock:
+                self.stats.dropped += 1
+            return
+        with self.stats.lock:
+            self.stats.queued += 1
+
+    def run(self):
+        while True:
+            (handlers, record) = self.queue.get()
+            if record is None:
+                self.queue.task_done()
+                return
+            for handler in handlers:
+                if record.levelno >= handler.level:
+                    handler.handle(record)
+            latency = time.time() - record.created
+            with self.stats.lock:
+                self.stats.handled += 1
+                self.stats.latency += latency
+                self.stats.slowest = max(self.stats.slowest, latency)
+            self.queue.task_done()
+
+    # Wait until the queued records are handled
+    def flush(self):
+        self.queue.join()
+
+    def stop(self):
+        self.queue.put(((), None))
+        self.join(5)
+        for handler in self.handlers:
+            handler.flush()
+        if self.stats.queued or self.stats.dropped:
+            sys.stderr.write(self.stats.report(self.name))
+
+
+# Handler putting the records for 'handlers' into the queue of 'listener'
+class QueueHandler(logging.Handler):
+    def __init__(self, listener, handlers):
+        super(QueueHandler, self).__init__()
+        self.listener = listener
+        self.handlers = handlers
+
+    def emit(self, record):
+        # merge the arguments now, they may change until handled
+        record.msg, record.args = record.getMessage(), None
+        self.listener.put(self.handlers, record)
+
+
+listener = None
+
+
+def start(capacity=CAPACITY, policy='drop', timeout=0.1):
+    global listener
+    if listener is None:
+        listener = Listener(capacity, policy, timeout)
+        listener.start()
+        atexit.register(listener.stop)
+    return listener
+
+
+def flush():
+    if listener is not None and listener.is_alive():
+        listener.flush()
+
+
+# Move the handlers of 'logger' behind the queue
+def install(logger, capacity=CAPACITY, policy='drop', timeout=0.1):
+    start(capacity, policy, timeout)
+    targets = list(logger.handlers)
+    listener.handlers.update(targets)
+    for handler in targets:
+        logger.removeHandler(handler)
+    logger.addHandler(QueueHandler(listener, targets))
+    return listener.stats
+
+
+# Put handlers of the given kinds (file handlers including the rotating
+# ones by default) behind the queue as they are added to any logger
+def patch(capacity=CAPACITY, policy='drop', timeout=0.1,
+          kinds=(logging.FileHandler,)):
+    start(capacity, policy, timeout)
+    add, remove = logging.Logger.addHandler, logging.Logger.removeHandler
+    wrappers = {}
+
+    def add_handler(logger, handler):
+        if isinstance(handler, kinds):
+            listener.handlers.add(handler)
+            wrapper = wrappers.setdefault(
+                handler, QueueHandler(listener, [handler]))
+            wrapper.setLevel(handler.level)
+            handler = wrapper
+        add(logger, handler)
+
+    def remove_handler(logger, handler):
+        remove(logger, wrappers.get(handler, handler))
+
+    logging.Logger.addHandler = add_handler
+    logging.Logger.removeHandler = remove_handler
+    return listener.stats
@@ -5,6 +5,7 @@
 # !!!ISSUE: make 'login.py -pass:xxx' work or use -oauth token
 #
 # Usage: $ python login-hack.py $PYWIKIBOT_TOKEN
+#        $ python login-hack.py --copy worker/pywikibot.lwp $PYWIKIBOT_TOKEN
 #
 # $ sudo docker run -it drtrigon/catimages-gsoc
 # # cd /opt/pywikibot-core
@@ -16,14 +17,127 @@
 # replace 'centralauth_Token=...;' by 'centralauth_Token=%(PYWIKIBOT_TOKEN)s;'
 #   in pywikibot.lwp.hack and commit then push
 #
+# The cookie jar is built once in a session cache shared by concurrent bot
+# workers (.sessions/ or $PYWIKIBOT_SESSIONS) and every call gets its own
+# copy of it (pywikibot writes to its jar). The cached jar is rebuilt under
+# an exclusive file lock when the token or pywikibot.lwp.hack changed or
+# it is older than --max-age seconds; every call is recorded in
+# sessions.jsonl there (session reused or created, time waited for the
+# lock).
+#
 # See also: Dockerfile, tasks.py
 #
 
 from __future__ import (division, absolute_import, unicode_literals,
                         print_function)
 
+import argparse
+import fcntl
+import hashlib
+import io
+import json
+import os
+import shutil
 import sys
+import time
+
+try:
+    from http.cookiejar import LWPCookieJar
+except ImportError:         # python 2
+    from cookielib import LWPCookieJar
+
+SESSIONS = os.environ.get('PYWIKIBOT_SESSIONS', '.sessions')
+TEMPLATE = 'pywikibot.lwp.hack'
+
+
+# Write a file atomically (concurrent readers see the old or the new one)
+def replace(path, data):
+    temp = "{0!s}.{1:d}".format(path, os.getpid())
+    with io.open(temp, 'w', encoding='utf-8') as f:
+        f.write(data)
+    os.rename(temp, path)
+
+
+# Earliest expiry of the cookies in a jar, None if none expires
+def expiry(path):
+    jar = LWPCookieJar(path)
+    jar.load(ignore_discard=True, ignore_expires=True)
+    times = [cookie.expires for cookie in jar if cookie.expires]
+    return min(times) if times else None
+
+
+def state(path):
+    try:
+        with open(path) as f:
+            return json.load(f)
+    except (IOError, OSError, ValueError):
+        return {}
+
+
+# Copy the cached jar for 'token' to 'target', (re)building it first if
+# needed; returns the call record
+def session(token, target, cache, max_age):
+    with io.open(TEMPLATE, encoding='utf-8') as f:
+        template = f.read()
+    key = hashlib.sha1((token + template).encode('utf-8')).hexdigest()
+    jar, meta = os.path.join(cache, 'pywikibot.lwp'), \
+        os.path.join(cache, 'session.json')
+
+    def current(info):
+        return info.get('key') == key and os.path.exists(jar) and \
+            time.time() - info.get('created', 0) < max_age
+
+    record = {'time': time.time(), 'pid': os.getpid(), 'copy': target,
+              'session': 'reused'}
+    with open(os.path.join(cache, 'lock'), 'a') as lock:
+        fcntl.flock(lock, fcntl.LOCK_SH)
+        info = state(meta)
+        if not current(info):
+            # not atomic: others may rebuild it in between, check again
+            fcntl.flock(lock, fcntl.LOCK_EX)
+            info = state(meta)
+            if not current(info):
+                replace(jar, template % {'PYWIKIBOT_TOKEN': token})
+                info = {'key': key, 'created': time.time(),
+                        'expires': expiry(jar)}
+                replace(meta, json.dumps(info))
+                record['session'] = 'created'
+        record['wait'] = time.time() - record['time']
+        record['age'] = time.time() - info['created']
+        shutil.copyfile(jar, target + '.tmp')
+        os.rename(target + '.tmp', target)
+        with open(os.path.join(cache, 'sessions.jsonl'), 'a') as f:
+            f.write(json.dumps(record, sort_keys=True) + "\n")
+    if info.get('expires') and info['expires'] < time.time():
+        sys.stderr.write("login-hack: the session cookies expired on {0!s}, "
+                         "update {1!s}\n".format(
+                             time.strftime('%Y-%m-%d %H:%M:%S',
+                                           time.gmtime(info['expires'])),
+                             TEMPLATE))
+    return record
+
+
+def main(args):
+    parser = argparse.ArgumentParser(description="hacky login.py "
+                                                 "replacement")
+    parser.add_argument('--copy', default='pywikibot.lwp',
+                        help="cookie jar of this worker")
+    parser.add_argument('--cache', default=SESSIONS,
+                        help="session cache shared by the workers")
+    parser.add_argument('--max-age', type=float, default=86400,
+                        help="rebuild cached jars older than this (seconds)")
+    parser.add_argument('token', nargs='?', default='',
+                        help="centralauth token (nothing is done without)")
+    opts = parser.parse_args(args)
+    if len(opts.token) != 32:
+        return 0
+    try:
+        os.makedirs(opts.cache)
+    except OSError:                 # exists (possibly created concurrently)
+        pass
+    session(opts.token, opts.copy, opts.cache, opts.max_age)
+    return 0
+
 
-if (len(sys.argv) == 2) and (len(sys.argv[1]) == 32):
-    open('pywikibot.lwp', 'w').write(open('pywikibot.lwp.hack', 'r').read() %
-                                     {'PYWIKIBOT_TOKEN': sys.argv[1]})
+if __name__ == '__main__':
+    sys.exit(main(sys.argv[1:]))
@@ -0,0 +1,266 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+#
+# "memory timelines"
+# Parses the memory data of a run into one structured report (memory.json)
+# that is kept next to the run and compared against the one of the previous
+# run:
+#   rss    RSS timeline of profile-run.py or mprof (memory.dat, "MEM <MiB>
+#          <time>" lines): peak, final and growth slope
+#   heap   valgrind massif output (massif.out): heap timeline, peak heap and
+#          the allocation sites at the peak
+#   items  per item (test) RSS before it ran, from pytest_resources.py
+#          (tests.json)
+# Every timeline is split into one window per processed item (the pages
+# logged by the bot, the tests, default 10 windows); the memory floor of
+# every window is where the memory returns to between items. Floors rising
+# steadily across the windows are flagged as a likely leak.
+#
+# Usage: $ python memory-report.py --mprof profile-log/memory.dat \
+#            --log profile-log/out.log.gz --output profile-log/memory.json \
+#            --baseline .tasks-memory/log.json
+#        $ python memory-report.py --massif massif.out --tests \
+#            test-log/tests.json --output test-log/memory.json
+#
+# See also: tasks.py, profile-run.py, pytest_resources.py
+#
+
+from __future__ import (division, absolute_import, unicode_literals,
+                        print_function)
+
+import argparse
+import gzip
+import io
+import json
+import os
+import re
+import shutil
+import sys
+
+WINDOWS = 10
+LEAK_GROWTH = 0.1           # floor growth relative to the first floor
+LEAK_MINIMUM = 2 * 1024 ** 2                # bytes, ignore smaller growth
+LEAK_STEADY = 0.6           # fraction of the window steps growing
+TOLERANCE = 0.2             # relative increase over the baseline flagged
+SITES = 10                  # allocation sites listed at the peak
+PAGE = re.compile(r">>> (.*) <<<")
+ADDRESS = re.compile(r"^0x[0-9A-Fa-f]+: ")
+
+
+# RSS timeline [(seconds, bytes)] of an mprof format file
+def mprof(path):
+    points = []
+    with io.open(path, encoding='utf-8') as f:
+        for line in f:
+            fields = line.split()
+            if len(fields) >= 3 and fields[0] == 'MEM':
+                points.append((float(fields[2]), float(fields[1]) * 1024 ** 2))
+    if points:
+        start = points[0][0]
+        points = [(t - start, v) for (t, v) in points]
+    return points
+
+
+# Snapshots of a massif output file, every one a dict of its fields and
+# the (depth, bytes, site) lines of its heap tree
+def snapshots(path):
+    result, current, unit = [], None, 'i'
+    with io.open(path, encoding='utf-8', errors='replace') as f:
+        for line in f:
+            line = line.rstrip('\n')
+            if line.startswith('time_unit: '):
+                unit = line.split(': ', 1)[1]
+            elif line.startswith('snapshot='):
+                current = {'tree': []}
+                result.append(current)
+            elif current is None or line.startswith('#'):
+                continue
+            elif '=' in line and not line.startswith(' ') and \
+                    not line.startswith('n'):
+                (key, value) = line.split('=', 1)
+                current[key] = value
+            elif line.lstrip().startswith('n'):
+                depth = len(line) - len(line.lstrip())
+                (count, rest) = line.lstrip().split(': ', 1)
+                (size, site) = rest.split(' ', 1)
+                current['tree'].append((depth, int(size), site))
+    for shot in result:
+        shot['time_unit'] = unit
+    return result
+
+
+# Heap bytes of a snapshot (including the allocator overhead)
+def heap(shot):
+    return int(shot['mem_heap_B']) + int(shot['mem_heap_extra_B'])
+
+
+# Heap report of a massif output file: timeline of heap (+ extra) bytes,
+# the peak and the allocation sites (direct callers of the allocation
+# functions) at the peak
+def massif(path):
+    shots = snapshots(path)
+    if not shots:
+        return {'timeline': []}
+    peaks = [s for s in shots if s.get('heap_tree') == 'peak']
+    peak = peaks[0] if peaks else max(shots, key=heap)
+    sites = sorted(((size, ADDRESS.sub('', site))
+                    for (depth, size, site) in peak['tree'] if depth == 1),
+                   reverse=True)
+    return {'timeline': [(float(s['time']), heap(s)) for s in shots],
+            'peak': heap(peak), 'peak_time': float(peak['time']),
+            'time_unit': peak['time_unit'],
+            'sites': [{'bytes': size, 'site': site}
+                      for (size, site) in sites[:SITES]]}
+
+
+# Per item RSS [(index, bytes)] before every test of a tests.json, in the
+# order they ran
+def items(path):
+    with open(path) as f:
+        tests = json.load(f)['tests']
+    ordered = sorted((entry.get('start', 0), nodeid)
+                     for (nodeid, entry) in tests.items()
+                     if 'rss_before' in entry)
+    return [(i, tests[nodeid]['rss_before'])
+            for (i, (start, nodeid)) in enumerate(ordered)]
+
+
+# Number of pages processed according to a (gzip compressed) bot log
+def pages(path):
+    opener = gzip.open if path.endswith('.gz') else io.open
+    with opener(path, 'rb') as f:
+        return sum(1 for line in f
+                   if PAGE.search(line.decode('utf-8', 'replace')))
+
+
+# Least squares slope of y over x
+def slope(points):
+    if len(points) < 2:
+        return 0.0
+    mx = sum(x for (x, y) in points) / len(points)
+    my = sum(y for (x, y) in points) / len(points)
+    var = sum((x - mx) ** 2 for (x, y) in points)
+    if not var:
+        return 0.0
+    return sum((x - mx) * (y - my) for (x, y) in points) / var
+
+
+# Leak check of a timeline: the floors (minimum) of 'windows' consecutive
+# parts of it, the first part is left out as warm-up (imports, caches)
+def leak(timeline, windows):
+    size = len(timeline) / (windows + 1)
+    if size < 1 or windows < 3:
+        return {'windows': 0, 'leak': False}
+    floors = [min(v for (t, v) in timeline[int(i * size):int((i + 1) * size)])
+              for i in range(1, windows + 1)]
+    steps = [b - a for (a, b) in zip(floors, floors[1:])]
+    growth = floors[-1] - floors[0]
+    steady = sum(1 for step in steps if step > 0) / len(steps)
+    grown = growth > max(LEAK_GROWTH * floors[0], LEAK_MINIMUM)
+    return {'windows': windows, 'floors': floors, 'growth': growth,
+            'per_window': slope(list(enumerate(floors))),
+            'steady': steady, 'leak': grown and steady >= LEAK_STEADY}
+
+
+# Timeline summary: peak, final value, slope (per time unit) and leak check
+def summary(timeline, windows):
+    if not timeline:
+        return {'samples': 0, 'peak': 0, 'final': 0, 'slope': 0.0,
+                'leak': leak(timeline, windows)}
+    return {'samples': len(timeline),
+            'peak': max(v for (t, v) in timeline),
+            'final': timeline[-1][1],
+            'slope': slope(timeline),
+            'leak': leak(timeline, windows)}
+
+
+# Changes against the report of an earlier run, increases beyond
+# TOLERANCE are flagged as regressions
+def compare(report, previous):
+    changes = {}
+    for kind in ('rss', 'heap', 'items'):
+        for key in ('peak', 'final'):
+            (old, new) = (previous.get(kind, {}).get(key),
+                          report.get(kind, {}).get(key))
+            if old and new is not None:
+                changes["{0!s}.{1!s}".format(kind, key)] = {
+                    'before': old, 'after': new, 'ratio': new / old,
+                    'regression': new > old * (1 + TOLERANCE)}
+    return changes
+
+
+def mib(value):
+    return "{0:.1f} MiB".format(value / 1024 ** 2)
+
+
+def show(report):
+    for kind in ('rss', 'heap', 'items'):
+        if kind not in report:
+            continue
+        part = report[kind]
+        print("{0!s}: peak {1!s}, final {2!s}, {3:d} samples{4!s}".format(
+            kind, mib(part['peak']), mib(part['final']), part['samples'],
+            ", LIKELY LEAK: floor grew by {0!s} over {1:d} windows".format(
+                mib(part['leak']['growth']), part['leak']['windows'])
+            if part['leak']['leak'] else ""))
+    for site in report.get('heap', {}).get('sites', []):
+        print("  {0!s:>12}  {1!s}".format(mib(site['bytes']), site['site']))
+    for (key, change) in sorted(report.get('changes', {}).items()):
+        print("{0!s}: {1!s} -> {2!s} ({3:+.0%}){4!s}".format(
+            key, mib(change['before']), mib(change['after']),
+            change['ratio'] - 1, ", REGRESSION" if change['regression']
+            else ""))
+
+
+def main(args):
+    parser = argparse.ArgumentParser(description="memory timelines")
+    parser.add_argument('--mprof', help="RSS timeline (memory.dat)")
+    parser.add_argument('--massif', help="valgrind massif output")
+    parser.add_argument('--tests', help="tests.json of pytest_resources.py")
+    parser.add_argument('--log', help="bot log, one leak check window per "
+                                      "page")
+    parser.add_argument('--windows', type=int, default=None,
+                        help="leak check windows (default: pages, tests or "
+                             "{0:d})".format(WINDOWS))
+    parser.add_argument('--output', default='memory.json')
+    parser.add_argument('--baseline',
+                        help="report of the previous run to compare with, "
+                             "replaced by this one")
+    parser.add_argument('--strict', action='store_true',
+                        help="fail on a likely leak or a regression")
+    opts = parser.parse_args(args)
+
+    report, windows = {}, opts.windows
+    if opts.log and windows is None and os.path.exists(opts.log):
+        windows = pages(opts.log)
+    if opts.tests:
+        timeline = items(opts.tests)
+        if windows is None:
+            windows = len(timeline)
+        # (one point per test, the first one is the warm-up)
+        report['items'] = summary(timeline, min(windows, len(timeline) - 1))
+    windows = windows or WINDOWS
+    if opts.mprof:
+        report['rss'] = summary(mprof(opts.mprof), windows)
+    if opts.massif:
+        heap = massif(opts.massif)
+        report['heap'] = dict(summary(heap.pop('timeline'), windows), **heap)
+    if opts.baseline and os.path.exists(opts.baseline):
+        with open(opts.baseline) as f:
+            report['changes'] = compare(report, json.load(f))
+    with open(opts.output, 'w') as f:
+        json.dump(report, f, indent=4, sort_keys=True)
+    if opts.baseline:
+        directory = os.path.dirname(opts.baseline)
+        if directory and not os.path.isdir(directory):
+            os.makedirs(directory)
+        shutil.copyfile(opts.output, opts.baseline)
+    show(report)
+    failed = any(part['leak']['leak'] for part in report.values()
+                 if 'leak' in part) or \
+        any(c['regression'] for c in report.get('changes', {}).values())
+    return 1 if failed and opts.strict else 0
+
+
+if __name__ == '__main__':
+    sys.exit(main(sys.argv[1:]))
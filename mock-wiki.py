@@ -0,0 +1,562 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+#
+# "offline MediaWiki API"
+# Local stand-in for the parts of the Commons API used by the wikibot
+# scripts: siteinfo/userinfo/tokens/paraminfo, search and category members
+# (as lists and generators), imageinfo, info, revisions and categories of
+# file pages, login and (accepted but ignored) edits, plus the file
+# downloads. Pages are synthetic SVG/PNG files or the files of a directory
+# (e.g. recorded from Commons), every request is delayed by --latency
+# (+- --jitter) seconds and logged to --record if given; --errors and --lag
+# inject server errors and maxlag failures. With --config a
+# user-config.py and a 'mock' family pointing at the server are written,
+# run the bots with PYWIKIBOT2_DIR (PYWIKIBOT_DIR for newer pywikibot
+# versions) set to that directory.
+#
+# Usage: $ python mock-wiki.py --port 8099 --pages 1000 --latency 0.05 \
+#            --config mock-wiki &
+#        $ PYWIKIBOT2_DIR=mock-wiki wikibot-filemeta-log -search:'eth-bib' \
+#            -limit:5 -dry
+#
+# See also: tasks.py
+#
+
+from __future__ import (division, absolute_import, unicode_literals,
+                        print_function)
+
+import argparse
+import hashlib
+import json
+import os
+import random
+import struct
+import sys
+import threading
+import time
+import zlib
+
+try:
+    from http.server import BaseHTTPRequestHandler, HTTPServer
+    from socketserver import ThreadingMixIn
+    from urllib.parse import parse_qsl, quote, unquote, urlparse
+except ImportError:         # python 2
+    from BaseHTTPServer import BaseHTTPRequestHandler, HTTPServer
+    from SocketServer import ThreadingMixIn
+    from urllib import quote, unquote
+    from urlparse import parse_qsl, urlparse
+
+GENERATOR = "MediaWiki 1.31.0"
+TIMESTAMP = "2016-08-01T00:00:00Z"
+NAMESPACES = {-2: "Media", -1: "Special", 0: "", 1: "Talk", 2: "User",
+              3: "User talk", 4: "Commons", 5: "Commons talk", 6: "File",
+              7: "File talk", 8: "MediaWiki", 9: "MediaWiki talk",
+              10: "Template", 11: "Template talk", 12: "Help",
+              13: "Help talk", 14: "Category", 15: "Category talk"}
+# Parameter prefixes of the supported modules (for paraminfo)
+PREFIXES = {'search': 'sr', 'categorymembers': 'cm', 'allpages': 'ap',
+            'allimages': 'ai', 'imageinfo': 'ii', 'info': 'in',
+            'revisions': 'rv', 'categories': 'cl', 'categoryinfo': 'ci',
+            'pageprops': 'pp', 'siteinfo': 'si', 'userinfo': 'ui',
+            'tokens': '', 'filerepoinfo': 'fri', 'allmessages': 'am'}
+LISTS = ('search', 'categorymembers', 'allpages', 'allimages')
+QUERY = {'list': LISTS,
+         'prop': ('imageinfo', 'info', 'revisions', 'categories',
+                  'categoryinfo', 'pageprops'),
+         'meta': ('siteinfo', 'userinfo', 'tokens', 'filerepoinfo',
+                  'allmessages')}
+ACTIONS = ('query', 'paraminfo', 'login', 'clientlogin', 'logout', 'edit',
+           'purge')
+
+FAMILY = """# -*- coding: utf-8 -*-
+# generated by mock-wiki.py
+from __future__ import unicode_literals
+
+from pywikibot import family
+
+
+class Family(family.Family):
+    name = 'mock'
+    langs = {{'mock': '{host!s}:{port:d}'}}
+
+    def scriptpath(self, code):
+        return '/w'
+
+    def protocol(self, code):
+        return 'http'
+"""
+USER_CONFIG = """# -*- coding: utf-8 -*-
+# generated by mock-wiki.py
+from __future__ import unicode_literals
+
+try:
+    register_family_file('mock', {family!r})
+except NameError:           # newer pywikibot versions
+    user_families_paths = [{families!r}]
+family = 'mock'
+mylang = 'mock'
+usernames['mock']['mock'] = {user!r}
+password_file = {passwords!r}
+
+# log files written on a background thread (see log_queue.py)
+import sys as _sys
+_sys.path.insert(0, {repo!r})
+import log_queue as _log_queue
+_log_queue.patch(policy='drop')
+"""
+
+
+# Minimal RGB PNG image of the given size with a pattern depending on seed
+def png(width, height, seed):
+    rows = b"".join(b"\0" + bytes(bytearray(
+        v % 256 for x in range(width)
+        for v in (x * seed + y, x + y * seed, x ^ y ^ seed)))
+        for y in range(height))
+
+    def chunk(kind, data):
+        crc = zlib.crc32(kind + data) & 0xffffffff
+        return b"".join([struct.pack(b">I", len(data)), kind, data,
+                         struct.pack(b">I", crc)])
+    header = struct.pack(b">IIBBBBB", width, height, 8, 2, 0, 0, 0)
+    return b"".join([b"\x89PNG\r\n\x1a\n", chunk(b"IHDR", header),
+                     chunk(b"IDAT", zlib.compress(rows)), chunk(b"IEND", b"")])
+
+
+# SVG image of the given size with a few shapes depending on seed
+def svg(width, height, seed):
+    shapes = "".join(
+        '<circle cx="{0:d}" cy="{1:d}" r="{2:d}" fill="#{3:06x}"/>'.format(
+            (seed * 7 + i * 13) % width, (seed * 11 + i * 17) % height,
+            5 + (seed + i) % 20, (seed * 2654435761 + i) % 0xffffff)
+        for i in range(1 + seed % 8))
+    return ('<?xml version="1.0" encoding="UTF-8"?>\n<svg xmlns="http://www.'
+            'w3.org/2000/svg" width="{0:d}" height="{1:d}">{2!s}</svg>\n'
+            .format(width, height, shapes)).encode('utf-8')
+
+
+# File pages of the wiki: the files of a directory or synthetic ones
+class Pages(object):
+    def __init__(self, count, directory=None):
+        self.pages = []
+        self.content = {}
+        if directory:
+            names = sorted(os.listdir(directory))
+        else:
+            names = ["Mock {0:05d}.{1!s}".format(i, 'svg' if i % 2 else 'png')
+                     for i in range(count)]
+        for (i, name) in enumerate(names):
+            if directory:
+                with open(os.path.join(directory, name), 'rb') as f:
+                    data = f.read()
+                (width, height) = (0, 0)
+            else:
+                (width, height) = (64 + i % 64, 48 + i % 32)
+                data = (svg if name.endswith('.svg') else png)(
+                    width, height, i + 1)
+            self.content[name] = data
+            self.pages.append({
+                'pageid': i + 1, 'ns': 6, 'title': "File:" + name,
+                'name': name, 'size': len(data), 'width': width,
+                'height': height, 'sha1': hashlib.sha1(data).hexdigest(),
+                'mime': mime(name)})
+        self.titles = dict((p['title'], p) for p in self.pages)
+        self.ids = dict((p['pageid'], p) for p in self.pages)
+
+    def find(self, title=None, pageid=None):
+        if pageid is not None:
+            return self.ids.get(int(pageid))
+        return self.titles.get(title.replace('_', ' '))
+
+
+def mime(name):
+    ext = name.rsplit('.', 1)[-1].lower()
+    return {'svg': 'image/svg+xml', 'png': 'image/png', 'jpg': 'image/jpeg',
+            'jpeg': 'image/jpeg', 'gif': 'image/gif', 'tif': 'image/tiff',
+            'tiff': 'image/tiff', 'pdf': 'application/pdf',
+            'ogg': 'application/ogg'}.get(ext, 'application/octet-stream')
+
+
+# The API: params (dict of str) -> JSON serializable response
+class Api(object):
+    def __init__(self, pages, base):
+        self.pages = pages
+        self.base = base
+
+    def __call__(self, params, user):
+        action = params.get('action', 'help')
+        if action == 'query':
+            return self.query(params, user)
+        if action == 'paraminfo':
+            return self.paraminfo(params)
+        if action == 'login':
+            return {'login': {'result': 'Success', 'lguserid': 1,
+                              'lgusername': params.get('lgname', '')}}
+        if action == 'clientlogin':
+            return {'clientlogin': {'status': 'PASS',
+                                    'username': params.get('username', '')}}
+        if action == 'edit':                # accepted but not stored
+            return {'edit': {'result': 'Success', 'pageid': 1,
+                             'title': params.get('title'), 'oldrevid': 1,
+                             'newrevid': 2, 'newtimestamp': TIMESTAMP,
+                             'contentmodel': 'wikitext'}}
+        if action in ('logout', 'purge'):
+            return {action: {'result': 'Success'}}
+        return {'error': {'code': 'unknown_action',
+                          'info': "Unrecognized action: " + action}}
+
+    def query(self, params, user):
+        fv2 = params.get('formatversion') == '2'
+        result, more = {}, {}
+        for name in split(params.get('meta')):
+            result.update(self.meta(name, params, user, fv2))
+        for name in split(params.get('list')):
+            if name == 'allusers':      # any user exists (checked on login)
+                result[name] = [{'userid': 1, 'name': params.get('aufrom')}]
+                continue
+            if name not in LISTS:
+                result[name] = []
+                continue
+            (items, cont) = self.listing(name, PREFIXES[name], params)
+            result[name] = [dict((k, p[k]) for k in ('pageid', 'ns', 'title'))
+                            for p in items]
+            more.update(cont)
+        pages = []
+        if params.get('generator') in LISTS:
+            (pages, cont) = self.listing(
+                params['generator'], 'g' + PREFIXES[params['generator']],
+                params)
+            more.update(cont)
+        pages += [self.pages.find(title=t) or {'title': t, 'missing': True}
+                  for t in split(params.get('titles'))]
+        pages += [self.pages.find(pageid=i) or {'pageid': int(i),
+                                                'missing': True}
+                  for i in split(params.get('pageids'))]
+        if pages:
+            props = split(params.get('prop'))
+            pages = [self.page(p, props, params, fv2) for p in pages]
+            result['pages'] = pages if fv2 else dict(
+                (str(p.get('pageid', -1 - i)), p) for (i, p) in
+                enumerate(pages))
+        response = {'batchcomplete': True if fv2 else ''}
+        if result:
+            response['query'] = result
+        if more:
+            more['continue'] = '-||'
+            response['continue'] = more
+        return response
+
+    def meta(self, name, params, user, fv2):
+        if name == 'siteinfo':
+            return self.siteinfo(split(params.get('siprop')) or ['general'],
+                                 fv2)
+        if name == 'userinfo':
+            info = {'id': 1, 'name': user} if user else \
+                {'id': 0, 'name': '127.0.0.1', 'anon': True if fv2 else ''}
+            info.update({'groups': ['*', 'user'] if user else ['*'],
+                         'rights': ['read', 'edit', 'writeapi'],
+                         'messages': False if fv2 else None})
+            if not fv2:
+                del info['messages']
+            return {'userinfo': info}
+        if name == 'tokens':
+            return {'tokens': dict(
+                (kind + 'token', "0123456789abcdef+\\")
+                for kind in split(params.get('type')) or ['csrf'])}
+        if name == 'filerepoinfo':
+            return {'repos': [{'name': 'local', 'displayname': 'Mock',
+                               'rootUrl': self.base + '/files',
+                               'local': True if fv2 else ''}]}
+        return {name: []}
+
+    def siteinfo(self, props, fv2):
+        info = {}
+        for prop in props:
+            if prop == 'general':
+                info[prop] = {
+                    'mainpage': 'Main Page', 'base': self.base + '/wiki/',
+                    'sitename': 'Mock Commons', 'generator': GENERATOR,
+                    'lang': 'en', 'case': 'first-letter',
+                    'articlepath': '/wiki/$1', 'scriptpath': '/w',
+                    'script': '/w/index.php', 'server': self.base,
+                    'servername': urlparse(self.base).hostname,
+                    'wikiid': 'mockwiki', 'timezone': 'UTC',
+                    'timeoffset': 0, 'time': TIMESTAMP,
+                    'phpversion': '7.0.0', 'dbtype': 'mysql',
+                    'legaltitlechars': " %!\"$&'()*,\\-.\\/0-9:;=?@A-Z\\\\^_"
+                                       "`a-z~\\x80-\\xFF+",
+                    'maxuploadsize': 4294967296, 'minuploadchunksize': 1024,
+                    'fileextensions': [{'ext': e} for e in
+                                       ('png', 'gif', 'jpg', 'jpeg', 'svg',
+                                        'tif', 'tiff', 'pdf', 'ogg')],
+                    'writeapi': True if fv2 else '', 'readonly': False}
+                if not fv2:
+                    del info[prop]['readonly']
+            elif prop == 'namespaces':
+                info[prop] = dict((str(i), self.namespace(i, fv2))
+                                  for i in NAMESPACES)
+            elif prop in ('statistics', 'rightsinfo'):
+                info[prop] = {}
+            else:
+                info[prop] = []
+        return info
+
+    def namespace(self, i, fv2):
+        ns = {'id': i, 'case': 'first-letter', 'canonical': NAMESPACES[i],
+              'subpages': False if fv2 else None}
+        ns['name' if fv2 else '*'] = NAMESPACES[i]
+        if i == 0:
+            ns['content'] = True if fv2 else ''
+        if not fv2:
+            del ns['subpages']
+        return ns
+
+    def paraminfo(self, params):
+        paths = split(params.get('modules')) + \
+            ['query+' + m for m in split(params.get('querymodules'))]
+        return {'paraminfo': {'modules': [module(p) for p in paths]}}
+
+    # Page slice of a list or generator module and its continuation
+    def listing(self, name, prefix, params):
+        limit = params.get(prefix + 'limit', '10')
+        limit = 500 if limit == 'max' else int(limit)
+        start = params.get(prefix + 'offset') or \
+            params.get(prefix + 'continue') or 0
+        start = int(start)
+        items = self.pages.pages[start:start + limit]
+        cont = {}
+        if start + limit < len(self.pages.pages):
+            key = prefix + ('offset' if name == 'search' else 'continue')
+            cont[key] = start + limit if name == 'search' else \
+                str(start + limit)
+        return items, cont
+
+    def page(self, page, props, params, fv2):
+        result = dict((k, page[k]) for k in ('pageid', 'ns', 'title')
+                      if k in page)
+        if page.get('missing'):
+            result['ns'] = 6
+            result['missing'] = True if fv2 else ''
+            return result
+        name = page['name']
+        if 'imageinfo' in props:
+            url = self.base + '/files/' + quote(name.encode('utf-8'))
+            result['imagerepository'] = 'local'
+            result['imageinfo'] = [{
+                'timestamp': TIMESTAMP, 'user': 'Mock', 'userid': 1,
+                'size': page['size'], 'width': page['width'],
+                'height': page['height'], 'url': url,
+                'descriptionurl': self.base + '/wiki/' + quote(
+                    page['title'].replace(' ', '_').encode('utf-8')),
+                'sha1': page['sha1'], 'mime': page['mime'],
+                'mediatype': 'BITMAP', 'comment': '', 'metadata': []}]
+        if 'info' in props:
+            result.update({'contentmodel': 'wikitext', 'pagelanguage': 'en',
+                           'pagelanguagedir': 'ltr', 'touched': TIMESTAMP,
+                           'lastrevid': page['pageid'],
+                           'length': len(text(page))})
+        if 'revisions' in props:
+            content = {'contentmodel': 'wikitext',
+                       'contentformat': 'text/x-wiki',
+                       'content' if fv2 else '*': text(page)}
+            revision = {'revid': page['pageid'], 'parentid': 0,
+                        'user': 'Mock', 'userid': 1, 'timestamp': TIMESTAMP,
+                        'comment': '', 'sha1': page['sha1'],
+                        'slots': {'main': content}}
+            revision.update(content)
+            result['revisions'] = [revision]
+        if 'categories' in props:
+            result['categories'] = [{'ns': 14, 'title': "Category:Mock"}]
+        return result
+
+
+# Paraminfo of a module: its prefix, group, submodules and a limit
+def module(path):
+    name = path.split('+')[-1]
+    info = {'name': name, 'classname': 'Mock', 'path': path,
+            'group': 'action', 'prefix': PREFIXES.get(name, ''),
+            'source': 'MediaWiki',
+            'parameters': [{'name': 'limit', 'type': 'limit', 'max': 500,
+                            'highmax': 5000, 'min': 1, 'default': 10}]}
+    if path == 'main':
+        info['parameters'] = [submodules('action', ACTIONS, ''),
+                              {'name': 'format', 'type': ['json']}]
+    elif path == 'query':
+        info['parameters'] = [submodules(group, QUERY[group], 'query+')
+                              for group in sorted(QUERY)] + \
+            [{'name': 'generator', 'type': list(LISTS)}]
+    elif '+' in path:
+        info['group'] = [g for g in QUERY if name in QUERY[g]][0] \
+            if any(name in QUERY[g] for g in QUERY) else 'prop'
+        if name in LISTS:
+            info['generator'] = ''
+            info['parameters'].append({'name': 'namespace', 'multi': '',
+                                       'type': 'namespace'})
+        elif name == 'tokens':
+            info['parameters'] = [{'name': 'type', 'multi': '',
+                                   'type': ['csrf', 'login', 'patrol',
+                                            'watch', 'rollback']}]
+    return info
+
+
+def submodules(name, children, parent):
+    return {'name': name, 'multi': '', 'type': list(children), 'limit': 50,
+            'submodules': dict((c, parent + c) for c in children)}
+
+
+def text(page):
+    return ("== Summary ==\n{{{{Information\n|description=Mock file "
+            "{0!s}\n|date=2016-08-01\n|source=mock-wiki.py\n|author=Mock\n"
+            "}}}}\n\n[[Category:Mock]]\n".format(page['name']))
+
+
+def split(value):
+    return [v for v in (value or '').split('|') if v]
+
+
+class Server(ThreadingMixIn, HTTPServer):
+    daemon_threads = True
+
+
+class Handler(BaseHTTPRequestHandler):
+    protocol_version = 'HTTP/1.1'
+
+    def do_GET(self):
+        self.handle_request(urlparse(self.path).query)
+
+    def do_POST(self):
+        length = int(self.headers.get('Content-Length') or 0)
+        self.handle_request(self.rfile.read(length).decode('utf-8'))
+
+    def handle_request(self, query):
+        server = self.server
+        delay = server.latency + random.uniform(-server.jitter, server.jitter)
+        time.sleep(max(delay, 0))
+        with server.lock:
+            server.requests += 1
+        path = urlparse(self.path)
+        if path.path.startswith('/files/'):
+            data = server.api.pages.content.get(
+                unquote(str(path.path[len('/files/'):])))
+            if data is None:
+                return self.reply(404, b"not found", 'text/plain')
+            return self.reply(200, data, mime(path.path))
+        if path.path != '/w/api.php':
+            return self.reply(404, b"not found", 'text/plain')
+        params = dict(parse_qsl(urlparse(self.path).query))
+        params.update(parse_qsl(query))
+        # injected failures: overloaded server and replication lag
+        if random.random() < server.errors:
+            return self.reply(503, b"Service Unavailable", 'text/plain',
+                              {'Retry-After': '1'}, error='http503')
+        lag = random.uniform(0, server.lag)
+        if params.get('maxlag') and lag > float(params['maxlag']):
+            body = json.dumps({'error': {
+                'code': 'maxlag', 'host': 'mock', 'lag': lag, 'type': 'db',
+                'info': "Waiting for mock: {0:.1f} seconds lagged".format(
+                    lag)}}).encode('utf-8')
+            return self.reply(200, body, 'application/json; charset=utf-8',
+                              {'Retry-After': '1',
+                               'X-Database-Lag': str(int(lag))},
+                              error='maxlag')
+        user = None
+        if params.get('action') in ('login', 'clientlogin'):
+            user = params.get('lgname') or params.get('username')
+        for cookie in (self.headers.get('Cookie') or '').split(';'):
+            if cookie.strip().startswith('mockUser='):
+                user = cookie.strip()[len('mockUser='):]
+        body = json.dumps(server.api(params, user)).encode('utf-8')
+        headers = {}
+        if user:
+            headers['Set-Cookie'] = "mockUser={0!s}; path=/".format(user)
+        self.reply(200, body, 'application/json; charset=utf-8', headers)
+
+    def reply(self, status, body, content_type, headers=None, error=None):
+        self.send_response(status)
+        self.send_header('Content-Type', content_type)
+        self.send_header('Content-Length', str(len(body)))
+        for (key, value) in (headers or {}).items():
+            self.send_header(key, value)
+        self.end_headers()
+        self.wfile.write(body)
+        if self.server.record:
+            entry = {'time': time.time(), 'method': self.command,
+                     'path': urlparse(self.path).path, 'status': status,
+                     'bytes': len(body), 'error': error}
+            with self.server.lock:
+                self.server.record.write(json.dumps(entry) + "\n")
+                self.server.record.flush()
+
+    def log_message(self, fmt, *args):
+        if self.server.verbose:
+            BaseHTTPRequestHandler.log_message(self, fmt, *args)
+
+
+# Write user-config.py and families/mock_family.py for the server to path
+def configure(path, host, port, user):
+    families = os.path.join(path, 'families')
+    if not os.path.isdir(families):
+        os.makedirs(families)
+    family = os.path.abspath(os.path.join(families, 'mock_family.py'))
+    with open(family, 'w') as f:
+        f.write(FAMILY.format(host=host, port=port))
+    passwords = os.path.abspath(os.path.join(path, 'passwords'))
+    with open(passwords, 'w') as f:     # any password is accepted
+        f.write("({0!r}, 'mock')\n".format(str(user)))
+    os.chmod(passwords, 0o600)
+    with open(os.path.join(path, 'user-config.py'), 'w') as f:
+        f.write(USER_CONFIG.format(family=str(family), user=str(user),
+                                   families=str(os.path.dirname(family)),
+                                   passwords=str(passwords),
+                                   repo=str(os.path.dirname(
+                                       os.path.abspath(__file__)))))
+
+
+def main(args):
+    parser = argparse.ArgumentParser(description="offline MediaWiki API")
+    parser.add_argument('--host', default='localhost')
+    parser.add_argument('--port', type=int, default=8099)
+    parser.add_argument('--pages', type=int, default=1000,
+                        help="number of synthetic file pages")
+    parser.add_argument('--files', help="serve the files of this directory "
+                                        "instead of synthetic ones")
+    parser.add_argument('--latency', type=float, default=0.0,
+                        help="delay of every request in seconds")
+    parser.add_argument('--jitter', type=float, default=0.0,
+                        help="random +- variation of the delay in seconds")
+    parser.add_argument('--config', help="write user-config.py and the "
+                                         "'mock' family to this directory")
+    parser.add_argument('--errors', type=float, default=0.0,
+                        help="fraction of API requests failing with 503")
+    parser.add_argument('--lag', type=float, default=0.0,
+                        help="highest (random) replication lag in seconds, "
+                             "requests with a lower maxlag fail")
+    parser.add_argument('--user', default='DrTrigon')
+    parser.add_argument('--record', help="append a JSON line (time, path, "
+                                         "status, size) per request to this "
+                                         "file")
+    parser.add_argument('--verbose', action='store_true')
+    opts = parser.parse_args(args)
+    if opts.config:
+        configure(opts.config, opts.host, opts.port, opts.user)
+    # pages first, the server accepts connections once it is bound
+    api = Api(Pages(opts.pages, opts.files),
+              "http://{0!s}:{1:d}".format(opts.host, opts.port))
+    server = Server((opts.host, opts.port), Handler)
+    server.api = api
+    server.latency, server.jitter = opts.latency, opts.jitter
+    server.verbose, server.requests = opts.verbose, 0
+    server.errors, server.lag = opts.errors, opts.lag
+    server.lock = threading.Lock()
+    server.record = open(opts.record, 'a') if opts.record else None
+    sys.stderr.write("mock-wiki: serving {0:d} pages on {1!s}\n".format(
+        len(server.api.pages.pages), server.api.base))
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    sys.stderr.write("mock-wiki: {0:d} requests\n".format(server.requests))
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main(sys.argv[1:]))
@@ -0,0 +1,49 @@
+# -*- coding: utf-8 -*-
+#
+# "process tree usage"
+# Summed RSS and CPU time of a process and all its descendants, read from
+# /proc (linux). Processes running as another user (e.g. through sudo) are
+# included, CPU time of already waited for children is in cutime/cstime of
+# their parents.
+#
+# Usage: (budget-run.py, tasks.py)
+#          (rss_mib, cpu_seconds) = process_tree.usage(proc.pid)
+#
+# See also: budget-run.py, tasks.py
+#
+
+from __future__ import (division, absolute_import, unicode_literals,
+                        print_function)
+
+import os
+import resource
+
+PAGESIZE = resource.getpagesize()
+TICKS = os.sysconf(str('SC_CLK_TCK'))
+
+
+# RSS in MiB and CPU time in seconds of all processes of the tree below
+# (and including) pid
+def usage(pid):
+    stats = {}
+    for name in os.listdir('/proc'):
+        if not name.isdigit():
+            continue
+        try:
+            with open(os.path.join('/proc', name, 'stat')) as f:
+                data = f.read()
+        except (IOError, OSError):      # exited in the meantime
+            continue
+        fields = data[data.rindex(')') + 2:].split()
+        stats[int(name)] = (int(fields[1]),                     # ppid
+                            sum(int(v) for v in fields[11:15]),  # CPU ticks
+                            int(fields[21]))                    # RSS pages
+    tree, pending = set(), [pid]
+    while pending:
+        current = pending.pop()
+        tree.add(current)
+        pending.extend(p for (p, stat) in stats.items()
+                       if stat[0] == current and p not in tree)
+    tree = [p for p in tree if p in stats]
+    return (sum(stats[p][2] for p in tree) * PAGESIZE / 1024 ** 2,
+            sum(stats[p][1] for p in tree) / TICKS)
@@ -0,0 +1,333 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+#
+# "single pass profiling"
+# Runs a python script once and collects in the same process what formerly
+# needed separate runs of cProfile, /usr/bin/time -v and mprof:
+#   summary.json   start and wall time, user/sys CPU time, peak RSS, exit
+#                  status
+#   profile.pstats cProfile dump (e.g. for runsnakerun or snakeviz)
+#   profile.txt    cProfile statistics sorted by internal time
+#   memory.dat     sampled RSS timeline in mprof format ("MEM <MiB> <time>")
+# With --sample the call stacks of the main thread are sampled RATE times
+# per second instead of tracing every call with cProfile, cheap enough for
+# full-size runs:
+#   stacks.txt     collapsed stacks ("frame;frame;frame <samples>") of the
+#                  frames in the --include packages (e.g. for flamegraph.pl
+#                  or speedscope), time spent outside of them is attributed
+#                  to a "[package]" frame
+#   flamegraph.svg self-contained flame graph of the collapsed stacks
+# With --no-profile only summary.json and memory.dat are written, for
+# timings without any profiler overhead (benchmarks).
+#
+# Usage: $ python profile-run.py [--output DIR] [--interval SEC] -- \
+#            $(which wikibot-filemeta-log) -search:'eth-bib' -limit:5 -dry
+#        $ python profile-run.py [--output DIR] -m pytest [args]
+#        $ python profile-run.py --sample 100 \
+#            --include file_metadata,pywikibot,log_bot -- \
+#            $(which wikibot-filemeta-simple) -cat:SVG_files
+#        $ python profile-run.py --no-profile -- \
+#            $(which wikibot-filemeta-simple) -cat:SVG_files -limit:500
+#
+# See also: tasks.py
+#
+
+from __future__ import (division, absolute_import, unicode_literals,
+                        print_function)
+
+import argparse
+import cProfile
+import collections
+import functools
+import hashlib
+import io
+import itertools
+import json
+import os
+import pstats
+import resource
+import runpy
+import sys
+import threading
+import time
+import traceback
+from xml.sax.saxutils import escape
+
+PAGESIZE = resource.getpagesize()
+SELF = os.path.abspath(__file__)
+FRAME_HEIGHT = 16               # flame graph layout, in pixels
+CHAR_WIDTH = 7
+WIDTH = 1200
+
+
+# Current resident set size of this process in bytes
+def rss():
+    try:
+        with open('/proc/self/statm') as f:
+            return int(f.read().split()[1]) * PAGESIZE
+    except (IOError, OSError):      # no procfs, fall back to the peak
+        return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * 1024
+
+
+# Background thread sampling the RSS into an mprof compatible file
+class Sampler(threading.Thread):
+    def __init__(self, filename, interval, cmdline):
+        super(Sampler, self).__init__()
+        self.daemon = True
+        self.interval = interval
+        self.stopped = threading.Event()
+        self.file = io.open(filename, 'w')
+        self.file.write("CMDLINE {0!s}\n".format(cmdline))
+
+    def sample(self):
+        self.file.write("MEM {0:.6f} {1:.4f}\n".format(
+            rss() / 1024 ** 2, time.time()))
+
+    def run(self):
+        while not self.stopped.is_set():
+            self.sample()
+            self.stopped.wait(self.interval)
+
+    def stop(self):
+        self.stopped.set()
+        self.join()
+        self.sample()
+        self.file.close()
+
+
+# Background thread counting the sampled call stacks of a thread by their
+# code objects (resolved to frame labels only when written)
+class StackSampler(threading.Thread):
+    def __init__(self, rate, thread):
+        super(StackSampler, self).__init__()
+        self.daemon = True
+        self.interval = 1.0 / rate
+        self.target = thread
+        self.stopped = threading.Event()
+        self.counts = collections.Counter()
+
+    def sample(self):
+        frame = sys._current_frames().get(self.target)
+        stack = []
+        while frame is not None:
+            stack.append(frame.f_code)
+            frame = frame.f_back
+        self.counts[tuple(reversed(stack))] += 1
+
+    def run(self):
+        while not self.stopped.wait(self.interval):
+            self.sample()
+
+    def stop(self):
+        self.stopped.set()
+        self.join()
+
+
+# Dotted module name of a source file, relative to the longest sys.path
+# entry containing it
+def modname(filename, paths):
+    filename = os.path.abspath(filename)
+    for path in paths:
+        if filename.startswith(path + os.sep):
+            filename = filename[len(path) + 1:]
+            break
+    name = os.path.splitext(filename)[0].replace(os.sep, '.')
+    if name.endswith('.__init__'):
+        name = name[:-len('.__init__')]
+    return name.lstrip('.')
+
+
+# Whether a dotted module name belongs to one of the packages (also inner
+# ones, e.g. 'log_bot' for file_metadata.wikibot.log_bot)
+def included(module, packages):
+    return not packages or any(
+        "." + package + "." in "." + module + "." for package in packages)
+
+
+# Collapsed stacks ("frame;frame <samples>" lines) of the sampled stacks
+def collapse(counts, packages):
+    paths = sorted(set(os.path.abspath(p) for p in sys.path if p),
+                   key=len, reverse=True)
+    labels = {}
+
+    def label(code):
+        if code not in labels:
+            module = modname(code.co_filename, paths)
+            labels[code] = (module, "{0!s}:{1!s}".format(module,
+                                                         code.co_name))
+        return labels[code]
+
+    # the outermost frames are the ones of the profiler and runpy
+    def own(code):
+        return 'runpy' in code.co_filename or \
+            os.path.abspath(code.co_filename) == SELF
+
+    stacks = collections.Counter()
+    for (stack, count) in counts.items():
+        stack = list(itertools.dropwhile(own, stack))
+        frames = [label(code) for code in stack] or [('', '[idle]')]
+        names = [name for (module, name) in frames
+                 if included(module, packages)]
+        if not included(frames[-1][0], packages):
+            names.append("[{0!s}]".format(
+                frames[-1][0].split('.')[0] or 'python'))
+        stacks[";".join(names)] += count
+    return ["{0!s} {1:d}".format(stack, count)
+            for (stack, count) in sorted(stacks.items())]
+
+
+# Color of a frame, stable per top level package (warm flame graph hues)
+def color(name):
+    digest = hashlib.md5(name.split('.')[0].encode('utf-8')).digest()
+    return "rgb({0:d},{1:d},{2:d})".format(
+        205 + bytearray(digest)[0] % 50, 80 + bytearray(digest)[1] % 150,
+        bytearray(digest)[2] % 60)
+
+
+# Self-contained flame graph (SVG) of collapsed stacks, the callers at the
+# bottom and the frame widths proportional to their samples
+def flamegraph(lines, title):
+    root = [0, collections.OrderedDict()]   # samples, children
+    depth = 0
+    for line in lines:
+        (stack, count) = line.rsplit(' ', 1)
+        node = root
+        node[0] += int(count)
+        frames = stack.split(';') if stack else []
+        depth = max(depth, len(frames))
+        for name in frames:
+            node = node[1].setdefault(name, [0, collections.OrderedDict()])
+            node[0] += int(count)
+    height = (depth + 3) * FRAME_HEIGHT
+    scale = (WIDTH - 20) / (root[0] or 1)
+    rects = []
+
+    def draw(name, node, x, level):
+        width = node[0] * scale
+        if width < 0.5:             # too narrow to be seen
+            return
+        y = height - (level + 1) * FRAME_HEIGHT
+        text = name if len(name) * CHAR_WIDTH < width else \
+            name[:int(width // CHAR_WIDTH) - 2] + ".."
+        rects.append(
+            '<g><title>{0!s} ({1:d} samples, {2:.2f}%)</title>'
+            '<rect x="{3:.1f}" y="{4:d}" width="{5:.1f}" height="{6:d}" '
+            'fill="{7!s}" rx="2"/><text x="{8:.1f}" y="{9:d}">{10!s}</text>'
+            '</g>'.format(escape(name), node[0], 100.0 * node[0] / root[0],
+                          x, y, width, FRAME_HEIGHT - 1, color(name), x + 3,
+                          y + FRAME_HEIGHT - 4,
+                          escape(text) if width > 3 * CHAR_WIDTH else ''))
+        for (child, sub) in node[1].items():
+            draw(child, sub, x, level + 1)
+            x += sub[0] * scale
+
+    draw('all', root, 10, 0)
+    return (
+        '<?xml version="1.0" standalone="no"?>\n'
+        '<svg version="1.1" width="{0:d}" height="{1:d}" '
+        'xmlns="http://www.w3.org/2000/svg" '
+        'font-family="Verdana, sans-serif" font-size="11">\n'
+        '<rect width="100%" height="100%" fill="#f8f8f8"/>\n'
+        '<text x="{2:d}" y="{3:d}" text-anchor="middle" font-size="15">'
+        '{4!s}</text>\n{5!s}\n</svg>\n'.format(
+            WIDTH, height, WIDTH // 2, FRAME_HEIGHT + 4, escape(title),
+            "\n".join(rects)))
+
+
+# The profiler (none with --no-profile) and the target run under it
+def profile(opts, target):
+    if opts.sample:
+        profiler = StackSampler(opts.sample, threading.current_thread().ident)
+        profiler.start()
+        return (profiler, target)
+    if opts.profile:
+        profiler = cProfile.Profile()
+        return (profiler, functools.partial(profiler.runcall, target))
+    return (None, target)
+
+
+# Write what the profiler (a StackSampler or cProfile) collected
+def dump(profiler, include, path):
+    if isinstance(profiler, StackSampler):
+        profiler.stop()
+        stacks = collapse(profiler.counts,
+                          [p for p in include.split(',') if p])
+        with io.open(path('stacks.txt'), 'w', encoding='utf-8') as f:
+            f.write("".join(line + "\n" for line in stacks))
+        with io.open(path('flamegraph.svg'), 'w', encoding='utf-8') as f:
+            f.write(flamegraph(stacks, " ".join(sys.argv)))
+    else:
+        profiler.dump_stats(path('profile.pstats'))
+        with open(path('profile.txt'), 'w') as f:
+            pstats.Stats(path('profile.pstats'), stream=f).sort_stats(
+                'time').print_stats()
+
+
+def main(args):
+    parser = argparse.ArgumentParser(description="single pass profiling")
+    parser.add_argument('--output', default='profile',
+                        help="directory for the collected data")
+    parser.add_argument('--interval', type=float, default=0.1,
+                        help="memory sampling interval in seconds")
+    parser.add_argument('--sample', type=float, default=0, metavar='RATE',
+                        help="sample the call stacks RATE times per second "
+                             "instead of running cProfile")
+    parser.add_argument('--no-profile', dest='profile',
+                        action='store_false',
+                        help="only time and sample the memory, no profiler")
+    parser.add_argument('--include', default='',
+                        help="packages shown in the sampled stacks (comma "
+                             "separated, default: all)")
+    parser.add_argument('-m', dest='module', action='store_true',
+                        help="profile a library module (like python -m)")
+    parser.add_argument('script', help="python script to profile")
+    parser.add_argument('args', nargs=argparse.REMAINDER)
+    opts = parser.parse_args(args)
+    if not os.path.isdir(opts.output):
+        os.makedirs(opts.output)
+
+    def path(name):
+        return os.path.join(opts.output, name)
+
+    # run the script as if it was started directly
+    sys.argv = [opts.script] + opts.args
+    if opts.module:
+        sys.path[0] = os.getcwd()
+        target = functools.partial(runpy.run_module, opts.script,
+                                   run_name='__main__', alter_sys=True)
+    else:
+        sys.path[0] = os.path.dirname(os.path.abspath(opts.script))
+        target = functools.partial(runpy.run_path, opts.script,
+                                   run_name='__main__')
+    sampler = Sampler(path('memory.dat'), opts.interval, " ".join(sys.argv))
+    (profiler, target) = profile(opts, target)
+    status = 0
+    sampler.start()
+    start = time.time()
+    try:
+        target()
+    except SystemExit as e:
+        status = e.code if isinstance(e.code, int) else int(bool(e.code))
+    except Exception:
+        traceback.print_exc()
+        status = 1
+    finally:
+        wall = time.time() - start
+        sampler.stop()
+    if profiler:
+        dump(profiler, opts.include, path)
+    usage = resource.getrusage(resource.RUSAGE_SELF)
+    summary = {
+        'cmdline': sys.argv, 'exit': status, 'start': start, 'wall': wall,
+        'utime': usage.ru_utime, 'stime': usage.ru_stime,
+        'maxrss': usage.ru_maxrss,                          # KiB on linux
+    }
+    if opts.sample:
+        summary['samples'] = sum(profiler.counts.values())
+    with open(path('summary.json'), 'w') as f:
+        json.dump(summary, f, indent=4, sort_keys=True)
+    return status
+
+
+if __name__ == '__main__':
+    sys.exit(main(sys.argv[1:]))
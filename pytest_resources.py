@@ -0,0 +1,98 @@
+# -*- coding: utf-8 -*-
+#
+# "per test resource usage"
+# pytest plugin recording outcome, duration and peak RSS of every test into
+# a JSON file, the RSS is sampled by a background thread while a test runs
+# (and completed by the process peak in case it grew during the test).
+#
+# Usage: $ PYTHONPATH=.. python -m pytest -p pytest_resources \
+#            --resources-json=test-log/tests.json
+#
+# See also: tasks.py, profile-run.py
+#
+
+from __future__ import (division, absolute_import, unicode_literals,
+                        print_function)
+
+import json
+import os
+import resource
+import threading
+import time
+
+import pytest
+
+PAGESIZE = resource.getpagesize()
+
+
+# Current resident set size of this process in bytes
+def rss():
+    try:
+        with open('/proc/self/statm') as f:
+            return int(f.read().split()[1]) * PAGESIZE
+    except (IOError, OSError):      # no procfs, fall back to the peak
+        return maxrss()
+
+
+def maxrss():
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * 1024
+
+
+def pytest_addoption(parser):
+    group = parser.getgroup('resources')
+    group.addoption('--resources-json', default=None, metavar='PATH',
+                    help="write per test duration and peak RSS to PATH")
+    group.addoption('--resources-interval', default=0.01, type=float,
+                    help="RSS sampling interval in seconds")
+
+
+def pytest_configure(config):
+    path = config.getoption('resources_json')
+    if path:
+        config.pluginmanager.register(
+            Recorder(path, config.getoption('resources_interval')),
+            'resources-recorder')
+
+
+class Recorder(object):
+    def __init__(self, path, interval):
+        self.path = path
+        self.interval = interval
+        self.tests = {}
+        self.peak = 0
+        self.stopped = threading.Event()
+        self.thread = threading.Thread(target=self.sample)
+        self.thread.daemon = True
+        self.thread.start()
+
+    def sample(self):
+        while not self.stopped.wait(self.interval):
+            self.peak = max(self.peak, rss())
+
+    @pytest.hookimpl(hookwrapper=True)
+    def pytest_runtest_protocol(self, item, nextitem):
+        self.peak = before = rss()
+        start, peak = time.time(), maxrss()
+        yield
+        entry = self.tests.setdefault(item.nodeid, {'outcome': 'passed'})
+        entry['start'] = start
+        entry['duration'] = time.time() - start
+        entry['rss_before'] = before
+        entry['rss_peak'] = max(self.peak, rss())
+        if maxrss() > peak:
+            entry['rss_peak'] = max(entry['rss_peak'], maxrss())
+
+    def pytest_runtest_logreport(self, report):
+        entry = self.tests.setdefault(report.nodeid, {'outcome': 'passed'})
+        if report.failed or (report.skipped and report.when != 'teardown'):
+            entry['outcome'] = report.outcome
+        entry[report.when] = report.duration
+
+    def pytest_sessionfinish(self, session):
+        self.stopped.set()
+        directory = os.path.dirname(self.path)
+        if directory and not os.path.isdir(directory):
+            os.makedirs(directory)
+        with open(self.path, 'w') as f:
+            json.dump({'tests': self.tests, 'maxrss': maxrss()}, f,
+                      indent=4, sort_keys=True)
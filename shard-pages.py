@@ -0,0 +1,80 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+#
+# "page shards"
+# Splits the pages of a pywikibot page generator (e.g. -cat:SVG_files or
+# -search:'eth-bib' -limit:500) into disjoint shards by the hash of their
+# titles, the bots process each shard through -file: in a process of its
+# own. Written to the output directory:
+#   order.txt        all titles in generator order (to merge the outputs)
+#   shard-00.txt ... the pages of every shard as [[title]] lines
+#
+# Usage: $ python shard-pages.py --shards 4 --output shards -- \
+#            -cat:SVG_files -limit:500
+#        $ wikibot-filemeta-simple -file:shards/shard-00.txt
+#
+# See also: tasks.py
+#
+
+from __future__ import (division, absolute_import, unicode_literals,
+                        print_function)
+
+import argparse
+import hashlib
+import io
+import os
+import sys
+
+
+# Shard of a title, stable across runs and python versions (unlike hash())
+def shard(title, shards):
+    return int(hashlib.md5(title.encode('utf-8')).hexdigest(), 16) % shards
+
+
+def main(args):
+    parser = argparse.ArgumentParser(description="page shards")
+    parser.add_argument('--shards', type=int, default=2)
+    parser.add_argument('--output', default='shards',
+                        help="directory for the page lists")
+    parser.add_argument('args', nargs=argparse.REMAINDER,
+                        help="pywikibot page generator arguments")
+    opts = parser.parse_args(args)
+    if not os.path.isdir(opts.output):
+        os.makedirs(opts.output)
+
+    import pywikibot
+    from pywikibot import pagegenerators
+
+    factory = pagegenerators.GeneratorFactory()
+    handle = getattr(factory, 'handle_arg', None) or factory.handleArg
+    for arg in pywikibot.handle_args(
+            [a for a in opts.args if a != '--']):
+        if not handle(arg):
+            pywikibot.warning("ignoring {0!s}".format(arg))
+    generator = factory.getCombinedGenerator()
+    if generator is None:
+        parser.error("no page generator given")
+
+    def path(name):
+        return os.path.join(opts.output, name)
+
+    files = [io.open(path("shard-{0:02d}.txt".format(i)), 'w',
+                     encoding='utf-8') for i in range(opts.shards)]
+    counts = [0] * opts.shards
+    with io.open(path('order.txt'), 'w', encoding='utf-8') as order:
+        for page in generator:
+            title = page.title()
+            i = shard(title, opts.shards)
+            order.write(title + "\n")
+            files[i].write("[[{0!s}]]\n".format(title))
+            counts[i] += 1
+    for f in files:
+        f.close()
+    sys.stderr.write("shard-pages: {0:d} pages in {1:d} shards ({2!s})\n"
+                     .format(sum(counts), opts.shards,
+                             ", ".join(str(c) for c in counts)))
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main(sys.argv[1:]))
@@ -10,7 +10,31 @@
 # $ invoke install_file_metadata_pip install_pywikibot
 # $ invoke install_file_metadata_git install_pywikibot
 # $ invoke install_file_metadata_git --yes install_pywikibot --yes
+# $ invoke install_file_metadata_git --yes --jobs 4
+# $ invoke install_file_metadata_git --yes --resume
+# $ invoke install_file_metadata_git --yes --from-step 14
+# $ invoke install_file_metadata_git --yes --force
+# $ invoke install_file_metadata_git --yes --quiet
+# $ invoke install_file_metadata_git --yes --ccache
 # $ invoke install_docker --yes
+# $ invoke build_wheelhouse --yes install_file_metadata_pip --yes
+# $ invoke mirror_repositories --yes install_file_metadata_git --yes \
+#     install_pywikibot --yes
+# $ invoke install_file_metadata_git --yes --offline install_pywikibot \
+#     --yes --offline
+# $ invoke test_script --yes --valgrind
+# $ invoke mock_wiki --yes --latency 0.05 test_script --yes --mock
+# $ invoke mock_wiki --yes --stop
+# $ invoke sweep --yes --limits 5,50,500,5000
+# $ invoke tune --yes --limit 100 --errors 0.01 --lag 10
+# $ invoke shard --yes --bot simple --generator -cat:SVG_files --shards 4
+# $ invoke matrix --yes --quiet
+# $ invoke trace --output trace.json
+# $ invoke calibrate --margin 1.5
+# $ invoke estimate install_file_metadata_git,install_pywikibot,test_script \
+#     --git --jobs 4
+# $ invoke provision install_file_metadata_git,install_pywikibot,test_script \
+#     --yes --git
 #
 # Inspired by https://github.com/pypa/get-pip/blob/master/get-pip.py
 #         and http://www.pyinvoke.org/
@@ -43,10 +67,49 @@
 from __future__ import (division, absolute_import, unicode_literals,
                         print_function)
 
-from invoke import task
+from invoke import Task, task as invoke_task
+from invoke.exceptions import Failure, UnexpectedExit
+from invoke.runners import Result
 # from functools import wraps
+import atexit
+import codecs
+import collections
+import contextlib
+import copy
+import fcntl
+import hashlib
+import itertools
+import json
 import logging
+import math
+import functools
+import gzip
 import inspect
+import io
+import multiprocessing
+import os
+import re
+import resource
+import subprocess
+import sys
+import sysconfig
+import tempfile
+import threading
+import time
+
+import error_report
+import log_queue
+import process_tree
+
+try:
+    from shlex import quote
+except ImportError:         # python 2
+    from pipes import quote
+
+try:
+    argspec = inspect.getfullargspec
+except AttributeError:      # python 2
+    argspec = inspect.getargspec
 
 logging.basicConfig(
     # filename=fileName,
@@ -56,40 +119,1128 @@ logging.basicConfig(
     # level=logging.DEBUG
     level=logging.INFO
 )
-cmdno = 0
+# formatting and writing of the log records on a background thread (see
+# log_queue.py), the few records of the runner wait for space if needed
+log_queue.install(logging.getLogger(), policy='block', timeout=1.0)
 
 # TRAVIS = os.environ.get('CI', False) or \
 #          os.environ.get('TRAVIS', False)
 
+# Resources that can not be shared between concurrently running steps
+# (apt/dpkg hold a system wide lock, parallel pip installs corrupt each
+# other), steps get these locks assigned automatically by their command
+LOCKS = [
+    ('dpkg', ("apt-get ", "apt-key ", "dpkg ")),
+    ('pip', ("pip install ", "pip uninstall ")),
+]
+# Locks on system wide resources, shared with concurrent task processes
+SHARED = ('dpkg',)
+
+
+# Thread-safe step counter (replaces the former global 'cmdno')
+class Counter(object):
+    def __init__(self, start=0):
+        self._count = itertools.count(start + 1)
+        self._lock = threading.Lock()
+
+    def next(self):
+        with self._lock:
+            return next(self._count)
+
+
+# On-disk journal of completed steps (JSON lines), used by --resume; the
+# entries of the tasks of an invocation are dropped once all of them
+# completed, so --resume continues the last unfinished chain of tasks only
+JOURNAL = '.tasks-journal.jsonl'
+# Per step timing and resource usage of all runs (JSON lines), see 'trace'
+TRACE = '.tasks-trace.jsonl'
+# Failure and traceback records parsed from the step output (JSON lines)
+FAILURES = '.tasks-failures.jsonl'
+# Local wheels of file-metadata and its dependencies, see 'build_wheelhouse'
+WHEELHOUSE = os.path.join('wheelhouse', "{0!s}-py{1:d}{2:d}".format(
+    sysconfig.get_platform(), *sys.version_info[:2]))
+# Local bare mirrors of the git repositories, see 'mirror_repositories'
+MIRRORS = 'mirrors'
+REPOSITORIES = collections.OrderedDict([
+    ('file-metadata',
+     "https://github.com/pywikibot-catfiles/file-metadata.git"),
+    ('pywikibot-core', "https://gerrit.wikimedia.org/r/pywikibot/core.git"),
+    ('pywikibot-i18n', "https://gerrit.wikimedia.org/r/pywikibot/i18n.git"),
+])
+# Packages downloaded for upcoming steps of interactive runs (Prefetcher)
+PREFETCH = '.tasks-prefetch'
+# Working directories of the concurrent install variants, see 'matrix'
+MATRIX = 'matrix'
+# Login session cache of login-hack.py, shared by the 'matrix' variants
+SESSIONS = '.sessions'
+# Wrapper enforcing the resource budgets of steps
+BUDGET_RUN = os.path.join(os.path.dirname(os.path.abspath(__file__)),
+                          'budget-run.py')
+# The RSS of the process tree of a step running longer than RSS_DELAY
+# seconds is sampled every RSS_INTERVAL seconds (see 'stream'), the one of
+# a budgeted step by budget-run.py
+RSS_DELAY = 1.0
+RSS_INTERVAL = 1.0
+# Local stand-in of the Commons API (mock-wiki.py) for reproducible bot
+# benchmarks, its generated pywikibot config, log and pid go to MOCK_WIKI
+MOCK_WIKI = 'mock-wiki'
+MOCK_PORT = 8099
+# The bots benchmarked by 'sweep' and 'tune' and run by 'shard': script,
+# page generator and further options (without -limit)
+BOTS = collections.OrderedDict([
+    ('log', ('wikibot-filemeta-log', "-search:'eth-bib'", "-dry")),
+    ('simple', ('wikibot-filemeta-simple', "-cat:SVG_files", "")),
+])
+# Scaling benchmark of the bots, see 'sweep': the growth exponent above
+# which time or memory count as a regression
+SWEEP = 'sweep'
+SUPERLINEAR = 1.2
+# Sharded bot runs, see 'shard': page lists, logs and merged output; the
+# page header pywikibot prints before the output of every page (followed
+# by " ***" if it is not able to color it)
+SHARDS = 'shards'
+PAGE = re.compile(r"^>>> (.*) <<<")
+# Throughput settings of user-config.py tuned by 'tune' and their candidate
+# values, the first one is the current value (persistent_http is left out,
+# pywikibot ignores it)
+TUNE = 'tune'
+TUNING = collections.OrderedDict([
+    ('put_throttle', (10, 5, 1, 0)),
+    ('minthrottle', (0, 1)),
+    ('maxthrottle', (60, 10)),
+    ('maxlag', (5, 10, 30)),
+    ('special_page_limit', (500, 5000)),
+    ('max_queue_size', (64, 16, 256)),
+    ('socket_timeout', (120, 30)),
+    ('max_retries', (25, 5)),
+    ('retry_wait', (5, 1)),
+])
+# Compressed output of every step, one directory per run; the last
+# TAIL_LINES lines are kept in memory for the failure tail
+LOGS = '.tasks-logs'
+TAIL_LINES = 100
+# Persistent compiler cache of the source builds, see 'params' (--ccache)
+CCACHE = os.path.abspath('.ccache')
+# Memory reports of the previous runs the current ones are compared with,
+# see memory-report.py
+MEMORY = os.path.abspath('.tasks-memory')
+# Run control parameters, these do not change what a step does and are
+# therefore not part of the journal key
+OPTIONS = ('jobs', 'resume', 'from_step', 'force', 'quiet', 'errors')
+
+# Simple package installs the planner is able to coalesce, anything using
+# pipes, local paths, requirement files or URLs is left alone
+APT_INSTALL = re.compile(
+    r"^((?:sudo )?apt-get(?: -\S+)*) install((?: [\w.+:-]+)+)$")
+PIP_INSTALL = re.compile(
+    r"^((?:sudo )?(?:env (?:\S+=\S+ )+)?pip) install"
+    r"((?: (?:-\S+|[\w.=<>\[\],-]+))+)$")
+BARRIER = re.compile(r"apt-get +(?:-\S+ +)*(?:update|upgrade)|apt-key")
+
+# Output parsing: pytest sections ("=== FAILURES ===") and failures in them
+# ("___ test_name ___"), python tracebacks and ANSI color codes; records are
+# limited to their first and last RECORD_LINES // 2 lines
+SECTION = re.compile(r"^={3,} (.*) ={3,}$")
+FAILURE = re.compile(r"^_{3,} (.*) _{3,}$")
+TRACEBACK = re.compile(r"^Traceback \(most recent call last\):")
+CONTINUED = re.compile(r"^(\s|Traceback |During handling |The above exc)")
+ANSI = re.compile(r"\x1B\[[0-9;]*[mK]")
+RECORD_LINES = 200
+
+cmdno = Counter()
+console = threading.Lock()
+# Collects (taskname, steps, deps, kwargs, tasks) instead of executing while
+# the 'provision' task is planning
+plan = None
+# Names of the currently running (nested) tasks, maintained by 'Tracked'
+hierarchy = []
+# Background error reporter (see error_report.py) of the running task, the
+# failure records of steps with a 'report' file are handed to it
+sending = None
+# Identifies all steps traced by this invocation
+runid = "{0:d}-{1:d}".format(int(time.time()), os.getpid())
+resources = {}
+resources_lock = threading.Lock()
+journal_lock = threading.Lock()
+trace_lock = threading.Lock()
+# Tasks run by this invocation and the ones of them that failed (see
+# 'journaled')
+ran, failed = set(), set()
+
+
+# Task class tracking the hierarchy of (nested) task calls; cheap compared
+# to inspecting the call stack on every step
+class Tracked(Task):
+    def __call__(self, *args, **kwargs):
+        hierarchy.append(self.body.__name__)
+        try:
+            return super(Tracked, self).__call__(*args, **kwargs)
+        finally:
+            hierarchy.pop()
+
+
+def task(*args, **kwargs):
+    kwargs.setdefault('klass', Tracked)
+    return invoke_task(*args, **kwargs)
+
+
+# Job step with dependencies: by default (after=None) a step depends on its
+# predecessor in the job list, after=() makes it independent and a tuple of
+# step names declares explicit dependencies. Plain strings in a job list are
+# equivalent to Step(cmd). Files listed in 'inputs' are fingerprinted into
+# the journal key, so a step is redone on --resume when they change. The
+# desired 'state' of a step is a tuple of ('apt'|'pip', package) pairs, it
+# is derived from the command for simple apt-get and pip installs. Failures
+# parsed from the output are additionally written to the 'report' file in
+# the input format of the rollbar CLI and sent to the error sinks of the
+# task (see 'reporting'). The whole output is written to the gzip
+# compressed 'log' file (by default in LOGS). A prefetched step runs its
+# 'local' command instead (see Prefetcher), it is traced as 'cmd'. The
+# optional 'budget' ({'rss': MiB, 'cpu': seconds, 'wall': seconds}, see
+# 'calibrate') is enforced on the process tree of the step by budget-run.py.
+# A non-zero exit status of a 'warn' step is traced and reported like a
+# failure parsed from its output, but does not stop the job.
+class Step(object):
+    def __init__(self, cmd, name=None, after=None, locks=None, inputs=(),
+                 state=(), report=None, log=None, budget=None, warn=False):
+        self.cmd = cmd
+        self.name = name
+        self.after = after
+        self.locks = locks
+        self.inputs = inputs
+        self.state = state
+        self.report = report
+        self.log = log
+        self.budget = budget
+        self.warn = warn
+        self.key = None
+        self.skip = None            # reason for not running the step
+        self.merged = False
+        self.local = None           # command using prefetched artifacts
+        self.index = None           # position in the job (see --from-step)
+
+    def format(self, **kwargs):
+        step = copy.copy(self)
+        step.cmd = self.cmd.format(**kwargs)
+        if step.locks is None:
+            step.locks = tuple(name for (name, marks) in LOCKS
+                               if any(m in step.cmd for m in marks))
+        return step
+
+
+def resource_lock(name):
+    with resources_lock:
+        if name not in resources:
+            resources[name] = threading.Lock()
+            if name in SHARED:
+                resources[name] = FileLock(os.path.join(
+                    tempfile.gettempdir(), "tasks-{0!s}.lock".format(name)))
+        return resources[name]
+
+
+# Lock that is also held against other processes running tasks (through a
+# lock file), e.g. the concurrent variants of 'matrix'
+class FileLock(object):
+    def __init__(self, path):
+        self.path = path
+        self.lock = threading.Lock()
+        self.file = None
+
+    def acquire(self):
+        self.lock.acquire()
+        self.file = open(self.path, 'a')
+        fcntl.flock(self.file, fcntl.LOCK_EX)
+
+    def release(self):
+        fcntl.flock(self.file, fcntl.LOCK_UN)
+        self.file.close()
+        self.lock.release()
+
+    def __enter__(self):
+        self.acquire()
+
+    def __exit__(self, *exc):
+        self.release()
+
+
+# Fingerprint of step command, calling task and inputs (parameters, files)
+def fingerprint(step, taskname, kwargs):
+    sha = hashlib.sha1()
+    values = sorted((k, v) for (k, v) in kwargs.items() if k not in OPTIONS)
+    for item in [taskname, step.cmd, repr(values)]:
+        sha.update(item.encode('utf-8'))
+    for path in step.inputs:
+        if os.path.isfile(path):
+            with open(path, 'rb') as f:
+                sha.update(f.read())
+        else:
+            sha.update(b'missing')
+    return sha.hexdigest()
+
+
+# Keys of all steps recorded as completed in the journal
+def journal():
+    if not os.path.exists(JOURNAL):
+        return set()
+    keys = set()
+    with open(JOURNAL) as f:
+        for line in f:
+            try:
+                keys.add(json.loads(line)['key'])
+            except (ValueError, KeyError):
+                continue            # ignore lines truncated by a crash
+    return keys
+
+
+def record(step, taskname):
+    entry = {'key': step.key, 'task': taskname, 'cmd': step.cmd,
+             'time': time.time()}
+    with journal_lock, open(JOURNAL, 'a') as f:
+        f.write(json.dumps(entry, sort_keys=True) + "\n")
+
+
+# Drop the journal entries of the given tasks
+def forget(tasknames):
+    if not os.path.exists(JOURNAL):
+        return
+    with journal_lock:
+        with open(JOURNAL) as f:
+            lines = f.readlines()
+        keep = []
+        for line in lines:
+            try:
+                if json.loads(line)['task'] not in tasknames:
+                    keep.append(line)
+            except (ValueError, KeyError):
+                continue            # lines truncated by a crash
+        with open(JOURNAL + '.tmp', 'w') as f:
+            f.writelines(keep)
+        os.rename(JOURNAL + '.tmp', JOURNAL)
+
+
+# Resolve dependencies of a job into a list of sets of step indices
+def depends(steps):
+    names = dict((step.name, i) for (i, step) in enumerate(steps)
+                 if step.name)
+    deps = []
+    for (i, step) in enumerate(steps):
+        if step.after is None:
+            deps.append(set([i - 1]) if i else set())
+            continue
+        unknown = [name for name in step.after if name not in names]
+        if unknown:
+            raise ValueError("Step {0:d} depends on unknown step(s) "
+                             "{1!s}".format(i, ", ".join(unknown)))
+        deps.append(set(names[name] for name in step.after))
+    return deps
+
 
 # Install procedure
 def run(ctx, job, **kwargs):
-    global cmdno
     kwargs = params(**kwargs)
-    for cmd in job:
-        cmd = cmd.format(**kwargs)
-        print("\n" + ("--- " * 18))
-        lvl = 0
-        for item in inspect.stack()[1:][::-1]:
-            if ('/tasks.py' not in item[1]) or ('__call__' in item[3]):
-                continue
-            lvl += 1
-            logging.info("{0!s}> {1!s}:{2!s}".format(("-" * lvl),
-                                                     item[3], item[2]))
-        cmdno += 1
-        logging.info("Step {0:d} : {1!s}".format(cmdno, cmd))
-        print("--- " * 18)
+    tasks = tuple(hierarchy) or (sys._getframe(1).f_code.co_name,)
+    steps, deps = prepare(job, kwargs, tasks[-1])
+    if plan is not None:
+        plan.append((tasks[-1], steps, deps, kwargs, tasks))
+        return
+    if not kwargs['force']:
+        probe(ctx, steps)
+    with reporting(kwargs['errors']), journaled(tasks[-1]):
+        process(ctx, steps, deps, kwargs, tasks)
+
+
+# Note the outcome of a task for 'finish'
+@contextlib.contextmanager
+def journaled(taskname):
+    ran.add(taskname)
+    try:
+        yield
+    except BaseException:
+        failed.add(taskname)
+        raise
+
+
+# At the end of the invocation drop the journal entries of its tasks if all
+# of them completed; after a failure the whole chain (e.g. invoke
+# install_file_metadata_git --resume test_script --resume) is resumable
+@atexit.register
+def finish():
+    if ran and not failed:
+        forget(ran)
+
+
+# Send the failure records to the error sinks for the rollbar 'environment'
+# (None: none) while the steps run, waiting for the delivery at the end
+@contextlib.contextmanager
+def reporting(environment, timeout=60.0):
+    global sending
+    if not environment or sending is not None:   # nested task: outer one
+        yield
+        return
+    sending = error_report.Reporter(error_report.sinks(environment))
+    try:
+        yield
+    finally:
+        reporter, sending = sending, None
+        for sink in reporter.close(timeout):
+            logging.info("Errors: {0:d} record(s) sent to {1!s} in {2:d} "
+                         "batch(es), {3:d} failed, {4:d} pending {5!s}".format(
+                             sink['sent'], sink['sink'], sink['batches'],
+                             sink['failed'], sink['pending'],
+                             " ".join(sink['results'])))
+
+
+# Format the steps of a job and resolve dependencies and journal state
+def prepare(job, kwargs, taskname):
+    steps = [(item if isinstance(item, Step) else Step(item))
+             .format(**kwargs) for item in job]
+    deps = depends(steps)
+    completed = journal() if kwargs['resume'] else set()
+    for (i, step) in enumerate(steps):
+        step.key = fingerprint(step, taskname, kwargs)
+        step.index = i + 1
+        if i + 1 < kwargs['from_step']:
+            step.skip = "skipped"
+        elif step.key in completed and not step.inputs:
+            step.skip = "done"      # the ones with inputs see 'resolve'
+    return steps, deps
+
+
+# Fingerprint a step with input files again when it is about to run (the
+# steps it depends on, e.g. the clone, may have just created or changed
+# them), on --resume it is done if the journal has that key
+def resolve(step, kwargs, taskname):
+    if not step.inputs or step.skip:
+        return
+    step.key = fingerprint(step, taskname, kwargs)
+    if kwargs['resume'] and step.key in journal():
+        step.skip = "done"
+
+
+def process(ctx, steps, deps, kwargs, tasks):
+    # interactive confirmation needs the steps one after the other
+    jobs = kwargs['jobs'] if kwargs['yes'] else 1
+    if jobs <= 1:
+        prefetcher = None
+        if not kwargs['yes']:
+            # download for the upcoming steps while waiting for the operator
+            prefetcher = Prefetcher(ctx, steps)
+            prefetcher.start()
+        try:
+            for (i, step) in enumerate(steps):
+                if prefetcher:
+                    prefetcher.advance(i)
+                execute(ctx, step, kwargs, tasks)
+        finally:
+            if prefetcher:
+                prefetcher.stop()
+        return
+    schedule(steps, deps, jobs,
+             lambda step: execute(ctx, step, kwargs, tasks))
+
+
+# Execute a single step (thread-safe)
+def execute(ctx, step, kwargs, tasks):
+    resolve(step, kwargs, tasks[-1])
+    with console:
+        separator(blank=True)
+        for (lvl, name) in enumerate(tasks):
+            logging.info("{0!s}> {1!s}".format(("-" * (lvl + 1)), name))
+        number = cmdno.next()
+        logging.info("Step {0:d} : {1!s}{2!s}".format(
+            step.index, step.cmd,
+            " ({0!s})".format(step.skip) if step.skip else ""))
+        separator()
+        if step.skip:
+            # done by the step it was merged into, which already ran
+            if step.merged:
+                record(step, tasks[-1])
+            return
         if not kwargs['yes']:
             raw_input("[Enter] to continue or [Ctrl]+C to stop ...")
-        ctx.run(cmd)
+    locks = [resource_lock(name) for name in sorted(step.locks)]
+    for lock in locks:
+        lock.acquire()
+    try:
+        measure(ctx, step, number, tasks, kwargs['quiet'])
+    finally:
+        for lock in reversed(locks):
+            lock.release()
+    record(step, tasks[-1])
+
+
+# Run the command of a step and append its wall time, the user/sys CPU time
+# of child processes (getrusage, so these overlap for steps running in
+# parallel), the peak RSS of its own process tree and the exit status to
+# the trace. The output goes to the compressed step log and, unless quiet,
+# to the terminal.
+def measure(ctx, step, number, tasks, quiet=False):
+    entry = {'run': runid, 'step': number, 'index': step.index,
+             'cmd': step.cmd, 'task': tasks[-1], 'tasks': list(tasks),
+             'thread': threading.current_thread().name, 'exit': None}
+    if step.local:
+        entry['local'] = step.local
+    handlers = [functools.partial(reporter, step=step.cmd, task=tasks[-1])
+                for reporter in reporters]
+    report, rollbar = sending, None
+    if step.report:
+        rollbar = RollbarFile(step.report)
+        handlers.append(rollbar)
+        if report is not None:
+            handlers.append(functools.partial(report, step=step.cmd,
+                                              task=tasks[-1]))
+    log = Log(step.log or os.path.join(LOGS, runid,
+                                       "{0:03d}.log.gz".format(number)))
+    out = Parser(log.channel(None if quiet else Terminal(sys.stdout)),
+                 handlers)
+    err = Parser(log.channel(None if quiet else Terminal(sys.stderr)),
+                 handlers)
+    cmd, record = step.local or step.cmd, None
+    if step.budget:
+        record = os.path.join(LOGS, runid,
+                              "{0:03d}.budget.json".format(number))
+        cmd = budgeted(cmd, step.budget, record)
+    before = resource.getrusage(resource.RUSAGE_CHILDREN)
+    entry['start'], entry['maxrss'] = time.time(), None
+    try:
+        result = stream(ctx, cmd, out, err, None if record else entry)
+        entry['exit'] = getattr(result, 'exited', 0)
+        return result
+    except Exception as e:
+        entry['exit'] = getattr(getattr(e, 'result', None), 'exited', -1)
+        entry['tail'] = list(log.tail)
+        if quiet:
+            Terminal(sys.stderr).write("\n".join(entry['tail']) + "\n")
+        if not (step.warn and isinstance(e, UnexpectedExit)):
+            raise
+        tolerate(entry, handlers)
+        return e.result
+    finally:
+        out.close()
+        err.close()
+        log.close()
+        # the whole log of a failed step goes to the sinks as well
+        if rollbar and report is not None and (entry['exit'] or rollbar.count):
+            report.attach(log.path, step=step.cmd, task=tasks[-1])
+        after = resource.getrusage(resource.RUSAGE_CHILDREN)
+        entry['wall'] = time.time() - entry['start']
+        entry['utime'] = after.ru_utime - before.ru_utime
+        entry['stime'] = after.ru_stime - before.ru_stime
+        entry['log'] = log.path
+        if record:
+            account(entry, record, handlers)
+        with trace_lock, open(TRACE, 'a') as f:
+            f.write(json.dumps(entry, sort_keys=True) + "\n")
+        if quiet:
+            logging.info("Step {0:d} : exit {1!s} in {2:.1f}s, {3:d} lines "
+                         "logged to {4!s}".format(step.index, entry['exit'],
+                                                  entry['wall'], log.lines,
+                                                  log.path))
+
+
+# Run a command in the shell of invoke and write its output to the
+# file-like objects 'out' and 'err' only: ctx.run keeps the whole output of
+# a step in memory (Result.stdout/stderr) whatever its output streams are.
+# A non-zero exit status raises UnexpectedExit like ctx.run does. Unless
+# 'entry' is None the peak RSS of the process tree of the command goes to
+# entry['maxrss'] (KiB).
+def stream(ctx, cmd, out, err, entry):
+    shell = ctx.config.run.shell or '/bin/bash'
+    proc = subprocess.Popen([shell, '-c', cmd], stdout=subprocess.PIPE,
+                            stderr=subprocess.PIPE)
+    done = threading.Event()
+    pumps = [threading.Thread(target=pump, args=(pipe, target))
+             for (pipe, target) in ((proc.stdout, out), (proc.stderr, err))]
+    sampler = []
+    if entry is not None:
+        sampler.append(threading.Thread(target=sample,
+                                        args=(proc.pid, done, entry)))
+    for thread in pumps + sampler:
+        thread.daemon = True
+        thread.start()
+    try:
+        for thread in pumps:
+            thread.join()
+        exited = proc.wait()
+    except BaseException:           # e.g. KeyboardInterrupt
+        proc.kill()
+        raise
+    finally:
+        done.set()
+        for thread in sampler:
+            thread.join()
+    result = Result(command=cmd, shell=shell, exited=exited)
+    if exited:
+        raise UnexpectedExit(result)
+    return result
+
+
+# Copy the output of a pipe to a file-like object as it arrives; the pipe
+# is drained to the end even if writing fails (the command would block on
+# a full pipe otherwise), every failure is logged
+def pump(pipe, target):
+    decoder = codecs.getincrementaldecoder('utf-8')('replace')
+    for chunk in iter(functools.partial(os.read, pipe.fileno(), 4096), b''):
+        deliver(target, decoder.decode(chunk))
+    deliver(target, decoder.decode(b'', True))
+    pipe.close()
+
+
+def deliver(target, data):
+    try:
+        target.write(data)
+    except Exception:
+        logging.exception("Lost {0:d} characters of step output".format(
+            len(data)))
+
+
+# Sample the RSS of the process tree below pid into entry['maxrss'] (KiB,
+# the peak) from RSS_DELAY seconds on until 'done' is set; shorter steps
+# are not sampled (scanning /proc is not for free) and keep None
+def sample(pid, done, entry):
+    delay = RSS_DELAY
+    while not done.wait(delay):
+        rss = int(process_tree.usage(pid)[0] * 1024)
+        entry['maxrss'] = max(entry['maxrss'] or 0, rss)
+        delay = RSS_INTERVAL
+
+
+# Command running cmd under the given budget, the usage goes to 'record'
+def budgeted(cmd, budget, record):
+    parents(record)
+    return "{0!s} {1!s} {2!s}--record {3!s} -- {4!s}".format(
+        quote(sys.executable), quote(BUDGET_RUN),
+        "".join("--{0!s} {1!s} ".format(k, budget[k]) for k in sorted(budget)),
+        quote(record), quote(cmd))
+
+
+# Add the usage of a budgeted step to its trace entry, an exceeded budget is
+# reported like a failure parsed from the output
+def account(entry, record, handlers):
+    if not os.path.exists(record):
+        return
+    with open(record) as f:
+        data = json.load(f)
+    entry['budget'], entry['usage'] = data['budget'], data['usage']
+    entry['maxrss'] = int(data['usage']['rss'] * 1024)
+    if not data['exceeded']:
+        return
+    kind = entry['exceeded'] = data['exceeded']
+    title = "exceeded {0!s} budget ({1:.1f} > {2:.1f}): {3!s}".format(
+        kind, data['usage'][kind], data['budget'][kind], entry['cmd'])
+    logging.error("Step {0:d} : {1!s}".format(entry['index'], title))
+    for handler in handlers:
+        handler({'kind': 'budget', 'title': title, 'lines': [title],
+                 'truncated': 0})
+
+
+# Report the exit status of a failed 'warn' step like a failure parsed from
+# its output instead of stopping the job
+def tolerate(entry, handlers):
+    title = "exit {0!s}: {1!s}".format(entry['exit'], entry['cmd'])
+    logging.error("Step {0:d} : {1!s}".format(entry['index'], title))
+    for handler in handlers:
+        handler({'kind': 'exit', 'title': title, 'lines': [title],
+                 'truncated': 0})
+
+
+# Compressed log of the output of a step shared by its stdout and stderr
+# channels, with a ring buffer of the last TAIL_LINES lines
+class Log(object):
+    def __init__(self, path):
+        parents(path)
+        self.path = path
+        self.file = gzip.open(path, 'wb')
+        self.lock = threading.Lock()
+        self.tail = collections.deque(maxlen=TAIL_LINES)
+        self.lines = 0
+
+    def channel(self, stream):
+        return Channel(self, stream)
+
+    def write(self, data, lines):
+        with self.lock:
+            self.file.write(data.encode('utf-8'))
+            self.tail.extend(lines)
+            self.lines += len(lines)
+
+    def close(self):
+        with self.lock:
+            self.file.close()
+
+
+# Text stream writing to the terminal stream 'stream' in its encoding,
+# characters it cannot represent are replaced (python 2 encodes unicode as
+# ASCII when not writing to a tty)
+class Terminal(object):
+    def __init__(self, stream):
+        self.stream = stream
+        self.encoding = getattr(stream, 'encoding', None) or 'utf-8'
+
+    def write(self, data):
+        data = data.encode(self.encoding, 'replace')
+        if not isinstance(data, str):       # python 3 streams take text
+            data = data.decode(self.encoding)
+        self.stream.write(data)
+
+    def flush(self):
+        self.stream.flush()
+
+
+# File-like object writing to a step log and (optionally) a stream
+class Channel(object):
+    def __init__(self, log, stream=None):
+        self.log = log
+        self.stream = stream
+        self.partial = ''
+
+    def write(self, data):
+        lines = (self.partial + data).split('\n')
+        self.partial = lines.pop()[-4096:]
+        self.log.write(data, lines)
+        if self.stream:
+            self.stream.write(data)
+
+    def flush(self):
+        if self.stream:
+            self.stream.flush()
+
+
+# File-like object passing the output of a step through to 'stream' while
+# extracting pytest failures and python tracebacks line by line; complete
+# records are handed to all handlers (callables) right away
+class Parser(object):
+    def __init__(self, stream, handlers):
+        self.stream = stream
+        self.handlers = handlers
+        self.partial = ''
+        self.section = False        # inside the pytest FAILURES section
+        self.record = None
+
+    def write(self, data):
+        self.stream.write(data)
+        lines = (self.partial + data).split('\n')
+        self.partial = lines.pop()[-4096:]
+        for line in lines:
+            self.feed(ANSI.sub('', line).split('\r')[-1])
+
+    def flush(self):
+        self.stream.flush()
+
+    def close(self):
+        if self.partial:
+            self.feed(ANSI.sub('', self.partial).split('\r')[-1])
+            self.partial = ''
+        self.emit()
+
+    def feed(self, line):
+        section = SECTION.match(line)
+        if section:
+            self.emit()
+            self.section = section.group(1).strip() == 'FAILURES'
+        elif self.section and FAILURE.match(line):
+            self.emit()
+            self.start('failure', FAILURE.match(line).group(1), line)
+        elif TRACEBACK.match(line) and not self.section:
+            self.emit()
+            self.start('traceback', line, line)
+        elif self.record is not None:
+            self.append(line)
+
+    def start(self, kind, title, line):
+        self.record = {'kind': kind, 'title': title, 'head': [line],
+                       'tail': collections.deque(maxlen=RECORD_LINES // 2),
+                       'truncated': 0}
+
+    def append(self, line):
+        record = self.record
+        if record['kind'] == 'traceback' and not line.strip():
+            return self.emit()
+        if len(record['head']) < RECORD_LINES // 2:
+            record['head'].append(line)
+        else:
+            if len(record['tail']) == record['tail'].maxlen:
+                record['truncated'] += 1
+            record['tail'].append(line)
+        # the exception line ends a traceback
+        if record['kind'] == 'traceback' and not CONTINUED.match(line):
+            self.emit()
+
+    def emit(self):
+        if self.record is None:
+            return
+        record, self.record = self.record, None
+        record['lines'] = record.pop('head') + list(record.pop('tail'))
+        for handler in self.handlers:
+            handler(record)
+
+
+# Reporter appending failure records as JSON lines to a file
+class JsonLines(object):
+    def __init__(self, path):
+        self.path = path
+        self.lock = threading.Lock()
+
+    def __call__(self, record, **context):
+        entry = dict(record, **context)
+        with self.lock, open(self.path, 'a') as f:
+            f.write(json.dumps(entry, sort_keys=True) + "\n")
+
+
+# Reporter writing failure records in the input format of the rollbar CLI,
+# one "error <record>" per line with the line breaks replaced by \r
+class RollbarFile(JsonLines):
+    def __init__(self, path):
+        super(RollbarFile, self).__init__(path)
+        parents(path)
+        open(self.path, 'w').close()
+        self.count = 0
+
+    def __call__(self, record, **context):
+        with self.lock, io.open(self.path, 'a', encoding='utf-8') as f:
+            self.count += 1
+            f.write("error {0!s}\n".format("\r".join(record['lines'])))
+
+
+# Reporters called with every failure record of every step
+reporters = [JsonLines(FAILURES)]
+
+
+# DAG scheduler running independent steps in parallel on a pool of workers,
+# no new steps are started after a failure and the first error is re-raised
+def schedule(steps, deps, jobs, func):
+    cond = threading.Condition()
+    pending = dict(enumerate(deps))
+    done, running, errors = set(), set(), []
+
+    def worker(i):
+        try:
+            func(steps[i])
+        except BaseException as e:
+            errors.append(e)
+        with cond:
+            running.discard(i)
+            done.add(i)
+            cond.notify()
+
+    with cond:
+        while (pending and not errors) or running:
+            ready = [i for i in sorted(pending) if pending[i] <= done]
+            if not (ready or running):
+                raise ValueError("Cyclic step dependencies: {0!s}".format(
+                                 sorted(pending)))
+            for i in ready[:max(jobs - len(running), 0)]:
+                del pending[i]
+                running.add(i)
+                thread = threading.Thread(target=worker, args=(i,))
+                thread.daemon = True
+                thread.start()
+            cond.wait()
+    if errors:
+        raise errors[0]
+
+
+# Background downloads for the upcoming steps of an interactive run, these
+# do not change the system: apt-get --download-only fills the apt archive
+# cache (under the dpkg lock), pip download fills PREFETCH (the install then
+# gets --find-links) and git clones of known repositories update their
+# mirror (the clone is then done from it). Apt-get update/upgrade steps are
+# waited for as package sources may change. Failures are ignored, the step
+# simply runs as usual.
+class Prefetcher(threading.Thread):
+    def __init__(self, ctx, steps):
+        super(Prefetcher, self).__init__()
+        self.daemon = True
+        self.ctx = ctx
+        self.steps = steps
+        self.current = 0            # index of the step executed next
+        self.stopped = False
+        self.cond = threading.Condition()
+
+    def advance(self, i):
+        with self.cond:
+            self.current = i
+            self.cond.notify()
+
+    def stop(self):
+        with self.cond:
+            self.stopped = True
+            self.cond.notify()
+
+    def run(self):
+        for (i, step) in enumerate(self.steps):
+            with self.cond:
+                while BARRIER.search(step.cmd) and not step.skip and \
+                        self.current <= i and not self.stopped:
+                    self.cond.wait()
+                if self.stopped:
+                    return
+            if i > self.current and not step.skip:
+                self.fetch(step)
+
+    def fetch(self, step):
+        (group, names) = packages(step.cmd)
+        clone = re.match(r"^git clone (\S+) (\S+)$", step.cmd)
+        if group and group[0] == 'apt':
+            with resource_lock('dpkg'):
+                self.call("sudo -n apt-get --yes --download-only install "
+                          "{0!s}".format(" ".join(names)))
+        elif group:
+            opts = [o for o in group[2:] if o.startswith(('--no-index',
+                                                          '--find-links'))]
+            if self.call("{0!s} download --dest {1!s} {2!s}".format(
+                    re.sub(r"^sudo ", "", group[1]), PREFETCH,
+                    " ".join(opts + names))):
+                step.local = "{0!s} --find-links={1!s}".format(
+                    step.cmd, os.path.abspath(PREFETCH))
+        elif clone and clone.group(1) in REPOSITORIES.values():
+            name = [n for (n, url) in REPOSITORIES.items()
+                    if url == clone.group(1)][0]
+            path = os.path.abspath(os.path.join(MIRRORS, name + '.git'))
+            if self.call("(test -d {0!s} || git clone --mirror {1!s} {0!s}) "
+                         "&& cd {0!s} && git remote update --prune".format(
+                             path, clone.group(1))):
+                step.local = ("git clone {0!s} {1!s} && cd {1!s} && git "
+                              "remote set-url origin {2!s}".format(
+                                  path, clone.group(2), clone.group(1)))
+
+    # (no stdin: the terminal stays with the prompt of the main thread)
+    def call(self, cmd):
+        result = self.ctx.run(cmd, hide=True, warn=True, pty=False,
+                              in_stream=False)
+        return result is not None and result.ok
+
+
+# Run the given tasks in planning mode and return the collected jobs
+def collect(ctx, names, **kwargs):
+    global plan
+    plan = []
+    try:
+        for name in names:
+            func = globals()[name.strip().replace('-', '_')]
+            args = argspec(func.body).args
+            func(ctx, **dict((k, v) for (k, v) in kwargs.items()
+                             if k in args))
+        return plan
+    finally:
+        plan = None
+
+
+# Package group and packages of a simple apt-get or pip install command
+def packages(cmd):
+    cmd = " ".join(cmd.split())
+    apt, pip = APT_INSTALL.match(cmd), PIP_INSTALL.match(cmd)
+    if apt:
+        return ('apt', apt.group(1)), apt.group(2).split()
+    if not pip:
+        return None, []
+    words = [('--upgrade' if w == '-U' else w) for w in pip.group(2).split()]
+    opts = tuple(sorted(set(w for w in words if w.startswith('-'))))
+    return (('pip', pip.group(1)) + opts,
+            [w for w in words if not w.startswith('-')])
+
+
+# Merge the package installs of all planned steps into as few apt-get and
+# pip calls as possible and drop duplicates. Installs are hoisted to the
+# first install of their kind, but never across an apt-get update/upgrade
+# (package sources may change) and pip installs never across an apt-get
+# install (source builds need the system libraries). Returns a mapping of
+# merged step index to the index of the step it was merged into.
+def coalesce(steps):
+    targets, merged, into = {}, {}, {}
+    for (i, step) in enumerate(steps):
+        if step.skip:
+            continue
+        if BARRIER.search(step.cmd):
+            targets.clear()
+        group, words = packages(step.cmd)
+        if group is None:
+            continue
+        if group not in targets:
+            if group[0] == 'apt':
+                for key in [k for k in targets if k[0] == 'pip']:
+                    del targets[key]
+            targets[group] = i
+            merged[i] = (group, [])
+        names = merged[targets[group]][1]
+        names.extend(w for w in words if w not in names)
+        if targets[group] != i:
+            into[i] = targets[group]
+    for i in set(into.values()):
+        steps[i].cmd = command(*merged[i])
+    return into
+
+
+def command(group, names):
+    return "{0!s} install {1!s}".format(
+        group[1], " ".join(group[2:] + tuple(names)))
+
+
+# Installed apt packages (one dpkg-query call) and pip distributions with
+# their versions (one pip freeze call, --all includes pip itself)
+def installed(ctx):
+    state = {}
+    result = ctx.run("dpkg-query -W -f='${Package} ${Status}\\n'",
+                     hide=True, warn=True)
+    for line in result.stdout.splitlines():
+        if line.endswith(" install ok installed"):
+            state[('apt', line.split()[0])] = ''
+    result = ctx.run("pip freeze --all || pip freeze", hide=True, warn=True)
+    for line in result.stdout.splitlines():
+        if '==' in line and not line.startswith('-'):
+            (name, version) = line.split('==', 1)
+            state[('pip', distname(name))] = version.strip()
+    return state
+
+
+def distname(spec):
+    return re.split(r"[=<>!\[;]", spec)[0].strip().lower().replace('_', '-')
+
+
+# Whether the requirement (kind, spec) is satisfied by the installed state,
+# pinned pip versions ('pkg==1.0') are compared
+def satisfied(state, kind, spec):
+    if kind == 'apt':
+        return (kind, spec.split(':')[0]) in state
+    version = state.get((kind, distname(spec)))
+    if version is None:
+        return False
+    return ('==' not in spec) or (spec.split('==', 1)[1] == version)
+
+
+# Whether a command upgrades pip packages
+def upgrade(cmd):
+    (group, names) = packages(cmd)
+    return bool(group) and '--upgrade' in group
+
+
+# Probe the installed state in bulk and skip the steps whose desired state
+# is already satisfied, simple installs are reduced to the missing packages;
+# upgrades (pip --upgrade/-U) always run, any installed version is no proof
+# of the latest one
+def probe(ctx, steps):
+    wanted = [step for step in steps
+              if (step.state or packages(step.cmd)[0])
+              if not (step.skip or upgrade(step.cmd))]
+    if not wanted:
+        return
+    state = installed(ctx)
+    for step in wanted:
+        if step.state:
+            if all(satisfied(state, *item) for item in step.state):
+                step.skip = "satisfied"
+            continue
+        (group, names) = packages(step.cmd)
+        missing = [n for n in names if not satisfied(state, group[0], n)]
+        if not missing:
+            step.skip = "satisfied"
+        elif len(missing) < len(names):
+            step.cmd = command(group, missing)
+
+
+# Create the missing parent directories of a file
+def parents(path):
+    if os.path.dirname(path) and not os.path.isdir(os.path.dirname(path)):
+        os.makedirs(os.path.dirname(path))
+
+
+# Local mirror of a repository (None if there is none), required in
+# offline mode
+def mirror(name, offline=False):
+    path = os.path.abspath(os.path.join(MIRRORS, name + '.git'))
+    if os.path.isdir(path):
+        return path
+    if offline:
+        raise ValueError("No mirror of {0!s} in {1!s}/ for --offline, run "
+                         "'invoke mirror_repositories' first".format(
+                             name, MIRRORS))
+    return None
+
+
+# Command cloning a repository to 'path': from upstream borrowing the
+# objects of its mirror if present (--reference, --dissociate), from the
+# mirror alone in offline mode (origin set back to upstream like in a
+# prefetched clone)
+def cloning(name, path, offline=False):
+    (local, upstream) = (mirror(name, offline), REPOSITORIES[name])
+    if local is None:
+        return "git clone {0!s} {1!s}".format(upstream, path)
+    if not offline:
+        return "git clone --reference {0!s} --dissociate {1!s} {2!s}".format(
+            local, upstream, path)
+    return ("git clone {0!s} {1!s} && cd {1!s} && git remote set-url origin "
+            "{2!s}".format(local, path, upstream))
+
+
+# All entries of the step trace
+def traced():
+    if not os.path.exists(TRACE):
+        return []
+    entries = []
+    with open(TRACE) as f:
+        for line in f:
+            try:
+                entries.append(json.loads(line))
+            except ValueError:
+                continue            # ignore lines truncated by a crash
+    return entries
 
 
 # Parameter procesing
 def params(*args, **kwargs):
     kwargs['yes'] = '--yes' if kwargs.get('yes', False) else ''
     kwargs['git'] = kwargs.get('git', False)
+    kwargs['jobs'] = int(kwargs.get('jobs', 1))
+    kwargs['resume'] = kwargs.get('resume', False)
+    kwargs['from_step'] = int(kwargs.get('from_step', 0))
+    kwargs['force'] = kwargs.get('force', False)
+    kwargs['quiet'] = kwargs.get('quiet', False)
+    kwargs['offline'] = kwargs.get('offline', False)
+    # rollbar environment the failures of steps with a 'report' file are
+    # sent for (see error_report.py), not if offline
+    kwargs['errors'] = kwargs.get('errors', None)
+    if kwargs['offline']:
+        kwargs['errors'] = None
+    # bots talk to the local mock-wiki.py instead of Commons
+    kwargs['mock'] = kwargs.get('mock', False)
+    kwargs['wiki'] = ''
+    if kwargs['mock']:
+        kwargs['wiki'] = "env PYWIKIBOT2_DIR={0!s} PYWIKIBOT_DIR={0!s}".format(
+            os.path.abspath(MOCK_WIKI))
+    # pip installs go to the active virtualenv (e.g. of a 'matrix' variant)
+    # instead of the system
+    kwargs['sudo'] = 'sudo'
+    if hasattr(sys, 'real_prefix') or \
+            sys.prefix != getattr(sys, 'base_prefix', sys.prefix):
+        kwargs['sudo'] = ''
+    kwargs['wheelhouse'] = WHEELHOUSE
+    # install from the local wheelhouse without index access if present
+    kwargs['wheels'] = ''
+    if os.path.isdir(WHEELHOUSE) and os.listdir(WHEELHOUSE):
+        kwargs['wheels'] = "--no-index --find-links={0!s}".format(WHEELHOUSE)
+    # build acceleration: compilers go through ccache (/usr/lib/ccache holds
+    # the gcc/g++/cc/c++ wrappers) and make, cmake and numpy.distutils use
+    # one job per core; the variables pass sudo via env (sudo resets them),
+    # the cache stays writable for the builds running as the user (e.g.
+    # build_wheelhouse) when filled by root (see also 'ccache_stats')
+    kwargs['ccache'] = kwargs.get('ccache', False)
+    kwargs['build'], kwargs['buildtools'] = '', ''
+    if kwargs['ccache']:
+        cores = multiprocessing.cpu_count()
+        kwargs['build'] = (
+            "env PATH=/usr/lib/ccache:$PATH CCACHE_DIR={0!s} CCACHE_UMASK=000 "
+            "CCACHE_BASEDIR={1!s} CCACHE_NOHASHDIR=1 MAKEFLAGS=-j{2:d} "
+            "CMAKE_BUILD_PARALLEL_LEVEL={2:d} NPY_NUM_BUILD_JOBS={2:d}".format(
+                CCACHE, os.getcwd(), cores))
+        kwargs['buildtools'] = 'ccache'
     return kwargs
 
+
+# Console separator line, after the log records queued so far
+def separator(blank=False):
+    log_queue.flush()
+    print(("\n" if blank else "") + ("--- " * 18))
+
 # Decorator for disabling tasks
 # def disabled(func):
 #     @wraps(func)
@@ -105,128 +1256,213 @@ def params(*args, **kwargs):
 
 # Function for disabling tasks
 def disabled(func):
-    print("\n" + ("--- " * 18))
+    separator(blank=True)
     logging.info("DISABLED : {0!s}".format(func))
-    print("--- " * 18)
+    separator()
 
 
 # Test through system package management
 @task
-def install_file_metadata_spm(ctx, yes=False):
+def install_file_metadata_spm(ctx, yes=False, ccache=False, resume=False,
+                              from_step=0, force=False, quiet=False):
     job = [
         "sudo apt-get {yes!s} update",
         # install most recent pip
         # assume pip to be already installed
-        "sudo pip install -U pip",
+        "{sudo!s} pip install -U pip",
         "pip show pip",
         # install spm setup dependencies
         "sudo apt-get {yes!s} install python-appdirs python-magic "
           "python-numpy python-scipy python-matplotlib python-wand "
           "python-skimage python-zbar cmake libboost-python-dev "
-          "liblzma-dev libjpeg-dev libz-dev",
+          "liblzma-dev libjpeg-dev libz-dev {buildtools!s}",
         # install additional dependencies for pip build
         "sudo apt-get {yes!s} install libzbar-dev",
         "sudo apt-get {yes!s} install libimage-exiftool-perl "
           "libav-tools",
         # install file-metadata through pip only
-        "sudo pip install file-metadata --upgrade",
+        "{sudo!s} {build!s} pip install {wheels!s} file-metadata --upgrade",
         # test import of file-metadata
         "python -c'import file_metadata; print(file_metadata.__version__)'",
-    ]
-    run(ctx, job, yes=yes)
+    ] + ccache_stats(ccache)
+    run(ctx, job, yes=yes, ccache=ccache, resume=resume, from_step=from_step,
+        force=force, quiet=quiet)
 
 
 # Test through pip
 @task
-def install_file_metadata_pip(ctx, yes=False):
+def install_file_metadata_pip(ctx, yes=False, ccache=False, resume=False,
+                              from_step=0, force=False, quiet=False):
     job = [
         "sudo apt-get {yes!s} update",
         # install most recent pip
         # assume pip to be already installed
-        "sudo pip install -U pip",
+        "{sudo!s} pip install -U pip",
         "pip show pip",
         # install pip setup dependencies
         "sudo apt-get {yes!s} install perl openjdk-7-jre python-dev "
           "pkg-config libfreetype6-dev libpng12-dev liblapack-dev "
           "libblas-dev gfortran cmake libboost-python-dev liblzma-dev "
-          "libjpeg-dev python-virtualenv",
+          "libjpeg-dev python-virtualenv {buildtools!s}",
         # install additional dependencies for pip build
         "sudo apt-get {yes!s} install libzbar-dev",
         "sudo apt-get {yes!s} install libimage-exiftool-perl "
           "libav-tools",
         # install file-metadata through pip only
-        "sudo pip install file-metadata --upgrade",
+        "{sudo!s} {build!s} pip install {wheels!s} file-metadata --upgrade",
         # test import of file-metadata
         "python -c'import file_metadata; print(file_metadata.__version__)'",
-    ]
-    run(ctx, job, yes=yes)
+    ] + ccache_stats(ccache)
+    run(ctx, job, yes=yes, ccache=ccache, resume=resume, from_step=from_step,
+        force=force, quiet=quiet)
 
 
 # Test through github
 @task
-def install_file_metadata_git(ctx, yes=False):
+def install_file_metadata_git(ctx, yes=False, jobs=1, valgrind=False,
+                              ccache=False, offline=False, resume=False,
+                              from_step=0, force=False, quiet=False):
+    # clone through the local mirror if there is one (see 'cloning')
+    clone = cloning('file-metadata', 'file-metadata', offline)
+    build, ready = [], ('pip', 'deps', 'zbar', 'tools', 'clone')
+    if ccache:
+        # compile the checkout once in place, the regular and the editable
+        # install below both pick up its build/ tree (and the cache)
+        build = [Step("cd file-metadata/ && {sudo!s} {build!s} python "
+                      "setup.py build", name='build',
+                      after=('deps', 'zbar', 'tools', 'clone'),
+                      inputs=('file-metadata/setup.py',))]
+        ready += ('build',)
     job = [
-        "sudo apt-get {yes!s} update",
+        Step("sudo apt-get {yes!s} update", name='update'),
         # install most recent pip
         # assume pip to be already installed
-        "sudo pip install -U pip",
+        Step("{sudo!s} pip install -U pip", name='pip', after=()),
         "pip show pip",
         # install git
-        "sudo apt-get {yes!s} install git git-review",
+        Step("sudo apt-get {yes!s} install git git-review", name='git',
+             after=('update',)),
         # install git setup dependencies
-        "sudo apt-get {yes!s} install perl openjdk-7-jre python-dev "
-          "pkg-config libfreetype6-dev libpng12-dev liblapack-dev "
-          "libblas-dev gfortran cmake libboost-python-dev liblzma-dev "
-          "libjpeg-dev python-virtualenv",
+        Step("sudo apt-get {yes!s} install perl openjdk-7-jre python-dev "
+             "pkg-config libfreetype6-dev libpng12-dev liblapack-dev "
+             "libblas-dev gfortran cmake libboost-python-dev liblzma-dev "
+             "libjpeg-dev python-virtualenv {buildtools!s}", name='deps',
+             after=('update',)),
         # install additional dependencies for pip build
-        "sudo apt-get {yes!s} install libzbar-dev",
-        "sudo apt-get {yes!s} install libimage-exiftool-perl "
-          "libav-tools",
+        Step("sudo apt-get {yes!s} install libzbar-dev", name='zbar',
+             after=('update',)),
+        Step("sudo apt-get {yes!s} install libimage-exiftool-perl "
+             "libav-tools", name='tools', after=('update',)),
         # install file-metadata through git+pip
-        "git clone https://github.com/pywikibot-catfiles/file-metadata.git",
-        "sudo pip install ./file-metadata --upgrade",
-        "sudo pip install -e ./file-metadata",
+        Step(clone, name='clone', after=('git',)),
+    ] + build + [
+        Step("{sudo!s} {build!s} pip install {wheels!s} ./file-metadata "
+             "--upgrade", after=ready, inputs=('file-metadata/setup.py',)),
+        "{sudo!s} {build!s} pip install {wheels!s} -e ./file-metadata",
         # test import of file-metadata
-        "python -c'import file_metadata; print(file_metadata.__version__)'",
+        Step("python -c'import file_metadata; "
+             "print(file_metadata.__version__)'", name='import'),
         # install optional dependency OpenCV
-        "sudo apt-get {yes!s} install python-opencv opencv-data",
+        Step("sudo apt-get {yes!s} install python-opencv opencv-data",
+             name='opencv', after=('update',)),
         # unit-test of file-metadata
-        "sudo pip install -r ./file-metadata/test-requirements.txt",
+        Step("{sudo!s} pip install {wheels!s} -r "
+             "./file-metadata/test-requirements.txt", name='testreq',
+             after=('clone', 'pip'),
+             inputs=('file-metadata/test-requirements.txt',)),
         # "cd file-metadata/ && python -m pytest --cov --durations=20 "
         #   "--pastebin=failed",
-        "cd file-metadata/ && python -m pytest --cov --durations=20 "
-          "--pastebin=failed | tee out.tmp",              # report error
+    ] + testing(valgrind, after=('import', 'opencv', 'testreq')) + [
         # error tracking and stats (report error instead of failing)
         # https://rollbar.com/docs/notifier/pyrollbar/#command-line-usage
-        "sudo pip install rollbar",
+        # Step("{sudo!s} pip install rollbar", name='rollbar',
+        #      after=('pip',)),
         # "rollbar -t cfde394e4c534722a0e55de1ef435190 -e test debug "
         #   "testing access token",
         # "cd file-metadata/ && cat out.tmp | awk '/= FAILURES =/,/\\n===/' |"
         #   " awk -v RS=\"\\f\" '{{gsub(/\\n/,\"\\r\")}}1' | "
         #   "awk '{{print \"error\",$0}}' | "
         #   "rollbar -t cfde394e4c534722a0e55de1ef435190 -e production -v",
-        "cd file-metadata/ && cat out.tmp | awk '/= FAILURES =/,/\\n===/' |"
-          " head -n -1 | awk -v RS=\"\\f\" '{{gsub(/\\n/,\"\\r\")}}1' | "
-          "awk -v RS=\"\\f\" '{{gsub(/\\x1B\\[[0-9;]*[mK]/,\"\")}}1' | "
-          "awk -v RS=\"\\f\" '{{gsub(/\\r___/,\"\\nerror ___\")}}1' | "
-          # "rollbar -t cfde394e4c534722a0e55de1ef435190 -e production -v",
-          "cat > out-send.tmp",
-        "cd file-metadata/ && cat out.tmp | nc termbin.com 9999",
-        "cd file-metadata/ && cat out-send.tmp | nc termbin.com 9999",
-        "cd file-metadata/ && cat out-send.tmp | "
-          # "rollbar -t cfde394e4c534722a0e55de1ef435190 -e production -v",
-          "rollbar -t cfde394e4c534722a0e55de1ef435190 -e test -v",
-    ]
-    run(ctx, job, yes=yes)
-    test_file_metadata_git(ctx, yes=yes)
+        # Step("cd file-metadata/ && zcat out.log.gz | nc termbin.com 9999",
+        #      after=('pytest',)),
+        # Step("cd file-metadata/ && cat out-send.tmp | nc termbin.com 9999",
+        #      name='send'),
+        # Step("cd file-metadata/ && cat out-send.tmp | "
+        #      "rollbar -t cfde394e4c534722a0e55de1ef435190 -e test -v",
+        #      after=('send', 'rollbar')),
+        # (failures are parsed from the output of the pytest step while it
+        # runs and sent together with its log to termbin and rollbar in the
+        # background, see 'reporting')
+    ] + ccache_stats(ccache)
+    run(ctx, job, yes=yes, jobs=jobs, ccache=ccache, offline=offline,
+        resume=resume, from_step=from_step, force=force, quiet=quiet,
+        errors='test')
 
 
-# Check performance for github: syntax, complexity, timing, memory
+# Build wheels of file-metadata and its whole dependency closure (and of the
+# test requirements of the github checkout if present) into the wheelhouse
+# of this platform and python version; existing wheels of unchanged
+# versions are reused, outdated ones removed
 @task
-def test_file_metadata_git(ctx, yes=False):
+def build_wheelhouse(ctx, yes=False, ccache=False, resume=False, from_step=0,
+                     force=False, quiet=False):
+    requirements = "file-metadata"
+    if os.path.exists('file-metadata/test-requirements.txt'):
+        requirements += " -r file-metadata/test-requirements.txt"
     job = [
-        "sudo pip install radon pprofile memory_profiler",
-        "sudo apt-get {yes!s} install valgrind gnuplot",
+        # install pip setup dependencies
+        "sudo apt-get {yes!s} install perl openjdk-7-jre python-dev "
+          "pkg-config libfreetype6-dev libpng12-dev liblapack-dev "
+          "libblas-dev gfortran cmake libboost-python-dev liblzma-dev "
+          "libjpeg-dev libzbar-dev {buildtools!s}",
+        "{sudo!s} pip install wheel",
+        "{build!s} pip wheel --wheel-dir={wheelhouse!s} "
+          "--find-links={wheelhouse!s} {requirements!s}",
+    ] + ccache_stats(ccache)
+    run(ctx, job, yes=yes, ccache=ccache, resume=resume, from_step=from_step,
+        force=force, quiet=quiet, requirements=requirements)
+    if plan is None:
+        prune(WHEELHOUSE)
+
+
+# Final step of the --ccache builds: cache hit rate since the last report
+# (statistics are reset after reporting); the cache entries created by the
+# builds as root are handed back to the user
+def ccache_stats(ccache):
+    if not ccache:
+        return []
+    return ["sudo env CCACHE_DIR={0!s} ccache -s -z && sudo chown -R "
+            "$(id -u):$(id -g) {0!s}".format(CCACHE)]
+
+
+# Remove all but the most recent wheel of every project in a wheelhouse
+def prune(path):
+    wheels = {}
+    for name in sorted(os.listdir(path),
+                       key=lambda n: os.path.getmtime(os.path.join(path, n))):
+        if name.endswith('.whl'):
+            wheels.setdefault(name.split('-')[0].lower(), []).append(name)
+    for names in wheels.values():
+        for name in names[:-1]:
+            logging.info("Removing outdated wheel {0!s}".format(name))
+            os.remove(os.path.join(path, name))
+
+
+# Check performance for github: syntax, complexity, timing, memory
+@task
+def test_file_metadata_git(ctx, yes=False, valgrind=False, resume=False,
+                           from_step=0, force=False, quiet=False):
+    run(ctx, testing(valgrind), yes=yes, resume=resume, from_step=from_step,
+        force=force, quiet=quiet)
+
+
+# Unit-test and analysis steps of the github checkout, the test suite runs
+# once and collects coverage, per test durations and peak memory and an
+# aggregate profile and memory timeline into file-metadata/test-log/
+def testing(valgrind=False, after=None):
+    return [
+        Step("{sudo!s} pip install radon", after=after),
+        "sudo apt-get {yes!s} install gnuplot",
         # complexity (--mccabe) and time (--profile, --durations) analysis
         # by pytest are too simplistic and buggy currently
         "cd file-metadata/ && flake8 --verbose --show-source --statistics "
@@ -237,22 +1473,51 @@ def test_file_metadata_git(ctx, yes=False):
           "setup.py setupdeps.py file_metadata tests",
         # "cd file-metadata/ && python -m pytest --cov --pastebin=failed",
         # "cd file-metadata/ && pprofile $(which py.test)",
-        "cd file-metadata/ && python -m cProfile -s time $(which py.test) > "
-          "profile.out && head profile.out -n 75",
-        "cd file-metadata/ && valgrind --tool=massif "
-          "--massif-out-file=massif.out --log-file=valgrind.log "
-          "python -m pytest || cat valgrind.log && ms_print massif.out | "
-          "head -n 50",
-        "/usr/bin/time -v $(which py.test) || true",
-        "mprof run $(which py.test) ; gnuplot -e 'set terminal dumb; "
-          "plot \"`ls -At mprof*.dat | head -n 1`\" using 3:2 with lines;'",
-    ]
-    run(ctx, job, yes=yes)
+        # single pass replacing the former separate pytest, cProfile,
+        # /usr/bin/time -v and mprof runs
+        Step("cd file-metadata/ && PYTHONPATH=.. python ../profile-run.py "
+             "--output test-log -m pytest --cov --cov-report=term "
+             "--cov-report=xml:test-log/coverage.xml --durations=20 "
+             "--junitxml=test-log/junit.xml -p pytest_resources "
+             "--resources-json=test-log/tests.json --pastebin=failed",
+             name='pytest', log='file-metadata/out.log.gz',
+             report='file-metadata/out-send.tmp', warn=True),  # report error
+        "cd file-metadata/ && cat test-log/summary.json && "
+          "head test-log/profile.txt -n 75 && "
+          "gnuplot -e 'set terminal dumb; "
+          "plot \"test-log/memory.dat\" using 3:2 with lines;'",
+        # memory timeline, per test floors and leak check to
+        # test-log/memory.json, compared with the previous run
+        "cd file-metadata/ && python ../memory-report.py "
+          "--mprof test-log/memory.dat --tests test-log/tests.json "
+          "--output test-log/memory.json --baseline {0!s}".format(
+              os.path.join(MEMORY, 'pytest.json')),
+    ] + ([
+        # heavyweight heap profiling (opt-in)
+        "sudo apt-get {yes!s} install valgrind",
+        Step("cd file-metadata/ && valgrind --tool=massif "
+             "--massif-out-file=massif.out --log-file=valgrind.log "
+             "python -m pytest || cat valgrind.log && ms_print massif.out | "
+             "head -n 50", budget={'wall': 3600}),
+        "cd file-metadata/ && python ../memory-report.py "
+          "--massif massif.out --output test-log/massif.json "
+          "--baseline {0!s}".format(
+              os.path.join(MEMORY, 'pytest-massif.json')),
+    ] if valgrind else [])
 
 
 # Installation of pywikibot
 @task
-def install_pywikibot(ctx, yes=False):
+def install_pywikibot(ctx, yes=False, offline=False, resume=False,
+                      from_step=0, force=False, quiet=False):
+    core = mirror('pywikibot-core', offline)
+    # the i18n submodule from upstream borrowing the objects of its mirror,
+    # from the mirror alone in offline mode
+    (i18n, reference) = (REPOSITORIES['pywikibot-i18n'], '')
+    if offline:
+        i18n = mirror('pywikibot-i18n', offline)
+    elif mirror('pywikibot-i18n'):
+        reference = " --reference {0!s}".format(mirror('pywikibot-i18n'))
     job = [
         # install git
         "sudo apt-get {yes!s} install git git-review",
@@ -260,16 +1525,52 @@ def install_pywikibot(ctx, yes=False):
         # "git clone --branch 2.0 --recursive "
         #   "https://gerrit.wikimedia.org/r/pywikibot/core.git",
         "wikibot-filemeta-log || true",
-        "sudo pip install "
-          "git+https://gerrit.wikimedia.org/r/pywikibot/core.git\#egg="
-          "pywikibot",
     ]
-    run(ctx, job, yes=yes)
+    if core is None:
+        job += [
+            Step("{sudo!s} pip install "
+                 "git+https://gerrit.wikimedia.org/r/pywikibot/core.git\#egg="
+                 "pywikibot", state=(('pip', 'pywikibot'),)),
+        ]
+    else:
+        # clone through the mirror (see 'cloning')
+        job += [
+            "rm -rf pywikibot-core && " + cloning('pywikibot-core',
+                                                  'pywikibot-core', offline),
+            "cd pywikibot-core/ && git submodule init && "
+              "git config submodule.scripts/i18n.url {i18n!s} && "
+              "git submodule update{reference!s}",
+            Step("{sudo!s} pip install ./pywikibot-core",
+                 state=(('pip', 'pywikibot'),)),
+        ]
+    run(ctx, job, yes=yes, offline=offline, resume=resume,
+        from_step=from_step, force=force, quiet=quiet, core=core, i18n=i18n,
+        reference=reference)
+
+
+# Create or incrementally update the local bare mirrors of the git
+# repositories, the install tasks clone from these if present
+@task
+def mirror_repositories(ctx, yes=False, resume=False, from_step=0,
+                        force=False, quiet=False):
+    job = [
+        "sudo apt-get {yes!s} install git",
+    ]
+    for (name, url) in REPOSITORIES.items():
+        path = os.path.join(MIRRORS, name + '.git')
+        job += [
+            "test -d {0!s} || git clone --mirror {1!s} {0!s}".format(
+                path, url),
+            "cd {0!s} && git remote update --prune".format(path),
+        ]
+    run(ctx, job, yes=yes, resume=resume, from_step=from_step, force=force,
+        quiet=quiet)
 
 
 # Install Docker container
 @task
-def install_docker(ctx, yes=False):
+def install_docker(ctx, yes=False, resume=False, from_step=0, force=False,
+                   quiet=False):
     job = [
         "sudo apt-get {yes!s} update",
         "sudo apt-get {yes!s} upgrade",
@@ -281,12 +1582,15 @@ def install_docker(ctx, yes=False):
         "sudo apt-get {yes!s} install docker-engine",
         # "sudo service docker start" % p,
     ]
-    run(ctx, job, yes=yes)
+    run(ctx, job, yes=yes, resume=resume, from_step=from_step, force=force,
+        quiet=quiet)
 
 
 # Test of pywikibot-catfiles scripts (and file-metadata) including analysis
 @task
-def test_script(ctx, yes=False, git=False):
+def test_script(ctx, yes=False, git=False, valgrind=False, mock=False,
+                sample=100, resume=False, from_step=0, force=False,
+                quiet=False):
     job = [
         # check wikibot scripts
         "type wikibot-create-config",
@@ -299,57 +1603,675 @@ def test_script(ctx, yes=False, git=False):
         # "cd file-metadata/file_metadata/wikibot/ && \"
         #   "python generate_user_files.py",
         # "wikibot-create-config",
+    ] + ([
 # work-a-round hacky login.py replacement: #  # noqa: E122
         "python login-hack.py $PYWIKIBOT_TOKEN",
 # end of work-a-round ######################  # noqa: E122
+    ] if not mock else []) + [                  # mock-wiki accepts any login
         # check login state
         # "wget https://raw.githubusercontent.com/.../scripts/login.py",
         # "python pwb.py login.py",
         # run bot tests
         # "wikibot-filemeta-log -search:'eth-bib' -limit:5 -dry || true",
-        "wikibot-filemeta-log -search:'eth-bib' -limit:5 -dry 2>&1 | "
-          "tee out-log.tmp",                              # report error
-        "sudo pip install pprofile memory_profiler",
-        "sudo apt-get {yes!s} install valgrind gnuplot",
-        "pprofile -o pprofile.out --include log_bot.py -- "
-          "$(which wikibot-filemeta-log) -search:'eth-bib' "
-          "-limit:5 -dry || cat pprofile.out",            # ignore error
-        "python -m cProfile -s time $(which wikibot-filemeta-log) "
-          "-search:'eth-bib' -limit:5 -dry > profile.out && "
-          "head profile.out -n 50",
-        "valgrind --tool=massif --massif-out-file=massif.out "
-          "--log-file=valgrind.log wikibot-filemeta-log "
-          "-search:'eth-bib' -limit:5 -dry || "           # ignore error
-          "cat valgrind.log && ms_print massif.out | "
-          "head -n 50 || true",                           # ignore error
-        "/usr/bin/time -v $(which wikibot-filemeta-log) "
-          "-search:'eth-bib' -limit:5 -dry || true",
-        "mprof run $(which wikibot-filemeta-log) -search:'eth-bib' -limit:5 "
-          "-dry ; gnuplot -e 'set terminal dumb; "
-          "plot \"`ls -At mprof*.dat | head -n 1`\" using 3:2 with lines;'",
+        # single instrumented run replacing the former separate plain,
+        # pprofile, cProfile, /usr/bin/time -v and mprof runs: wall/CPU time,
+        # peak RSS, memory timeline and cProfile stats go to profile-log/
+        "sudo apt-get {yes!s} install gnuplot",
+        Step("{wiki!s} python profile-run.py --output profile-log -- "
+             "$(which wikibot-filemeta-log) -search:'eth-bib' -limit:5 -dry",
+             log='profile-log/out.log.gz', report='out-log.tmp',
+             warn=True),                                # report error
+        "cat profile-log/summary.json && "
+          "head profile-log/profile.txt -n 50 && "
+          "gnuplot -e 'set terminal dumb; "
+          "plot \"profile-log/memory.dat\" using 3:2 with lines;'",
+        # memory timeline with one leak check window per page to
+        # profile-log/memory.json, compared with the previous run
+        "python memory-report.py --mprof profile-log/memory.dat "
+          "--log profile-log/out.log.gz --output profile-log/memory.json "
+          "--baseline {0!s}".format(
+              os.path.join(MEMORY, 'test_script-log.json')),
+    ] + ([
+        # heavyweight heap profiling (opt-in)
+        "sudo apt-get {yes!s} install valgrind",
+        Step("{wiki!s} valgrind --tool=massif --massif-out-file=massif.out "
+             "--log-file=valgrind.log wikibot-filemeta-log "
+             "-search:'eth-bib' -limit:5 -dry || "        # ignore error
+             "cat valgrind.log && ms_print massif.out | "
+             "head -n 50 || true",                        # ignore error
+             budget={'wall': 1800}),
+        "python memory-report.py --massif massif.out "
+          "--output profile-log/massif.json --baseline {0!s}".format(
+              os.path.join(MEMORY, 'test_script-massif.json')),
+    ] if valgrind else []) + [
         # "heaptrack python wikibot-filemeta-log "
         #   "-search:'eth-bib' -limit:5 -dry",
         # "wikibot-filemeta-simple -cat:SVG_files -limit:5",
-        "wikibot-filemeta-simple -cat:SVG_files -limit:5 2>&1 | "
-          "tee out-simple.tmp",                           # report error
+        # statistical profiling (cheap enough for full-size runs): collapsed
+        # stacks and flame graph of the bot go to sample-simple/
+        Step("{wiki!s} python profile-run.py --output sample-simple "
+             "--sample {sample!s} --include file_metadata,pywikibot,log_bot "
+             "-- $(which wikibot-filemeta-simple) -cat:SVG_files -limit:5",
+             report='out-simple.tmp', warn=True),       # report error
+        "cat sample-simple/summary.json && "
+          "awk '{{print $NF, $0}}' sample-simple/stacks.txt | sort -nr | "
+          "head -n 20 | cut -c 1-200",
         # error tracking and stats (report error instead of failing)
         # https://rollbar.com/docs/notifier/pyrollbar/#command-line-usage
-        "sudo pip install rollbar",
-        "cat out-log.tmp | awk '/Traceback /,!/./' | "
-          "awk -v RS=\"\\f\" '{{gsub(/\\n/,\"\\r\")}}1' | "
-          "awk -v RS=\"\\f\" '{{gsub(/Traceback /,\"error Traceback \")}}1' |"
-          " rollbar -t cfde394e4c534722a0e55de1ef435190 -e production -v",
-        "cat out-simple.tmp | awk '/Traceback /,!/./' | "
-          "awk -v RS=\"\\f\" '{{gsub(/\\n/,\"\\r\")}}1' | "
-          "awk -v RS=\"\\f\" '{{gsub(/Traceback /,\"error Traceback \")}}1' |"
-          " rollbar -t cfde394e4c534722a0e55de1ef435190 -e production -v",
+        # "{sudo!s} pip install rollbar",
+        # "cat out-log.tmp | awk '/Traceback /,!/./' | "
+        #   "awk -v RS=\"\\f\" '{{gsub(/\\n/,\"\\r\")}}1' | "
+        #   "awk -v RS=\"\\f\" '{{gsub(/Traceback /,\"error Traceback \")}}1'"
+        #   " | rollbar -t cfde394e4c534722a0e55de1ef435190 -e production -v",
+        # "cat out-log.tmp | "
+        #   "rollbar -t cfde394e4c534722a0e55de1ef435190 -e production -v",
+        # "cat out-simple.tmp | "
+        #   "rollbar -t cfde394e4c534722a0e55de1ef435190 -e production -v",
+        # (tracebacks are parsed from the output of the bot runs while they
+        # run and sent to termbin and rollbar in the background, see
+        # 'reporting'; a mock run sends them only to local stand-ins)
+    ]
+    errors = 'production'
+    if mock and not all(os.environ.get(name) for name in
+                        ('TASKS_TERMBIN', 'TASKS_ROLLBAR')):
+        errors = None
+    run(ctx, job, yes=yes, git=git, mock=mock, sample=sample, resume=resume,
+        from_step=from_step, force=force, quiet=quiet, errors=errors)
+
+
+# Start (or with --stop only stop) the local mock-wiki.py server in the
+# background: 'pages' synthetic files or the ones in 'files', each request
+# delayed by 'latency' +- 'jitter' seconds; 'test_script --mock' runs the
+# bots against it
+@task
+def mock_wiki(ctx, yes=False, pages=1000, files=None, latency=0.05,
+              jitter=0.0, stop=False, resume=False, from_step=0, force=False,
+              quiet=False):
+    job = serving(None if stop else pages, files, latency, jitter)
+    run(ctx, job, yes=yes, resume=resume, from_step=from_step, force=force,
+        quiet=quiet)
+
+
+# Steps stopping a running mock-wiki.py and unless pages is None starting
+# it again in the background, its requests are logged to 'record' if given
+def serving(pages=None, files=None, latency=0.0, jitter=0.0, record=None,
+            errors=0.0, lag=0.0):
+    pid = os.path.join(MOCK_WIKI, 'pid')
+    job = [
+        "test ! -f {0!s} || kill $(cat {0!s}) || true".format(pid),
+        "rm -f {0!s}".format(pid),
+    ]
+    if pages is None:
+        return job
+    options = "".join(" --{0!s} {1!s}".format(k, v) for (k, v) in (
+        ('files', files), ('record', record), ('errors', float(errors)),
+        ('lag', float(lag))) if v)
+    return job + [
+        "mkdir -p {0!s} && (nohup python mock-wiki.py --port {1:d} "
+          "--pages {2:d}{3!s} --latency {4!s} --jitter {5!s} "
+          "--config {0!s} < /dev/null > {0!s}/server.log 2>&1 & "
+          "echo $! > {6!s})".format(MOCK_WIKI, MOCK_PORT, int(pages),
+                                    options, float(latency), float(jitter),
+                                    pid),
+        # wait until it accepts connections (generating the pages takes a
+        # few seconds per thousand)
+        "for i in $(seq 600); do (echo > /dev/tcp/localhost/{0:d}) "
+          "2> /dev/null && break; sleep 0.1; done".format(MOCK_PORT),
+    ]
+
+
+# Command line of a bot (name of BOTS), optionally with another generator
+def botcmd(name, generator=None):
+    (script, default, options) = BOTS[name]
+    return " ".join(arg for arg in ("$(which {0!s})".format(script),
+                                    generator or default, options) if arg)
+
+
+# Run the bots (comma separated names of BOTS) against mock-wiki.py with
+# every size of 'limits' (comma separated) under profile-run.py and collect
+# throughput (files/s), the per-file latency percentiles (intervals between
+# the file downloads seen by the server) and the peak RSS per size in
+# sweep/summary.json. The growth of wall time and peak RSS beyond the cost
+# of the smallest size is fitted as power law, an exponent above
+# 'threshold' (superlinear) fails the task as a regression.
+@task
+def sweep(ctx, limits='5,50,500,5000', bots='log,simple', latency=0.0,
+          jitter=0.0, threshold=SUPERLINEAR, yes=False, quiet=False):
+    sizes = sorted(int(n) for n in limits.split(','))
+    record = os.path.join(SWEEP, 'requests.jsonl')
+    runs = collections.OrderedDict(
+        ((name, size), os.path.join(SWEEP, "{0!s}-{1:d}".format(name, size)))
+        for name in bots.split(',') for size in sizes)
+    job = ["rm -rf {0!s} && mkdir -p {0!s}".format(SWEEP)] + \
+        serving(max(sizes), None, latency, jitter, record) + [
+            "{{wiki!s}} python profile-run.py --no-profile --output {0!s} -- "
+            "{1!s} -limit:{2:d}".format(path, botcmd(name), size)
+            for ((name, size), path) in runs.items()]
+    try:
+        run(ctx, job, yes=yes, mock=True, quiet=quiet)
+    finally:
+        run(ctx, serving(), yes=yes, quiet=quiet)
+    if plan is None:
+        scaling(runs, record, float(threshold))
+
+
+# Per size results of the sweep runs ((bot, size): profile-run.py output)
+# and their growth, written to sweep/summary.json
+def scaling(runs, record, threshold):
+    requests = recorded(record)
+    summary = collections.OrderedDict()
+    for ((name, size), path) in runs.items():
+        profile = observe(path, requests)
+        count = len(profile['files']) or size
+        summary.setdefault(name, {'sizes': []})['sizes'].append({
+            'limit': size, 'files': count, 'wall': profile['wall'],
+            'throughput': count / profile['wall'],
+            'latency': dict(("p{0:d}".format(q),
+                             percentile(profile['latencies'], q))
+                            for q in (50, 90, 99)),
+            'maxrss': profile['maxrss'], 'exit': profile['exit']})
+    regressions = []
+    separator(blank=True)
+    for (name, result) in summary.items():
+        for entry in result['sizes']:
+            logging.info("{0!s:>6} : {1:5d} files in {2:.1f}s, {3:.2f} "
+                         "files/s, p50/p90/p99 {4!s}, {5:d} KiB".format(
+                             name, entry['files'], entry['wall'],
+                             entry['throughput'], "/".join(
+                                 "{0:.3f}".format(entry['latency'][p] or 0)
+                                 for p in ('p50', 'p90', 'p99')),
+                             entry['maxrss']))
+        result['growth'] = dict(
+            (metric, growth([(e['files'], e[metric])
+                             for e in result['sizes']]))
+            for metric in ('wall', 'maxrss'))
+        for (metric, exponent) in sorted(result['growth'].items()):
+            if exponent is not None and exponent > threshold:
+                regressions.append((name, metric, exponent))
+    separator()
+    with open(os.path.join(SWEEP, 'summary.json'), 'w') as f:
+        json.dump(summary, f, indent=4)
+    for (name, metric, exponent) in regressions:
+        logging.error("{0!s} : {1!s} grows superlinearly with the number of "
+                      "files (exponent {2:.2f} > {3:.2f})".format(
+                          name, metric, exponent, threshold))
+    if regressions:
+        sys.exit(1)
+
+
+# Requests logged by mock-wiki.py --record
+def recorded(record):
+    requests = []
+    if os.path.exists(record):
+        with open(record) as f:
+            requests = [json.loads(line) for line in f if line.strip()]
+    return requests
+
+
+# Summary of a profile-run.py output directory extended by what the server
+# saw during the run: the file downloads ('files', their times), the
+# intervals between them ('latencies'), the number of requests and of the
+# failed ones ('errors', HTTP errors and API errors like maxlag, pywikibot
+# retries each of them)
+def observe(path, requests):
+    with open(os.path.join(path, 'summary.json')) as f:
+        profile = json.load(f)
+    start, end = profile['start'], profile['start'] + profile['wall']
+    window = [r for r in requests if start <= r['time'] <= end]
+    profile['files'] = sorted(r['time'] for r in window
+                              if r['path'].startswith('/files/'))
+    profile['latencies'] = [b - a for (a, b) in zip(
+        [start] + profile['files'], profile['files'])]
+    profile['requests'] = len(window)
+    profile['errors'] = len([r for r in window
+                             if r['status'] != 200 or r.get('error')])
+    return profile
+
+
+# Nearest-rank percentile q of values, None without values
+def percentile(values, q):
+    if not values:
+        return None
+    values = sorted(values)
+    return values[max(int(math.ceil(q / 100 * len(values))) - 1, 0)]
+
+
+# Exponent k of the power law v - v0 = a * (n - n0)**k fitted (least
+# squares in log-log space) to the (n, v) points beyond the smallest one
+# (n0, v0), i.e. without the startup cost; None with less than two points
+def growth(points):
+    points = sorted(points)
+    (n0, v0) = points[0]
+    logs = [(math.log(n - n0), math.log(v - v0)) for (n, v) in points[1:]
+            if n > n0 and v > v0]
+    if len(logs) < 2:
+        return None
+    mx = sum(x for (x, y) in logs) / len(logs)
+    my = sum(y for (x, y) in logs) / len(logs)
+    var = sum((x - mx) ** 2 for (x, y) in logs)
+    if not var:
+        return None
+    return sum((x - mx) * (y - my) for (x, y) in logs) / var
+
+
+# Run a bot (name of BOTS) as 'shards' processes in parallel (default one
+# per core), each on a disjoint part of the pages: shard-pages.py splits the
+# pages of 'generator' (default the one of BOTS) by title hash and every
+# process gets its part through -file:. Their outputs are merged to
+# shards/<bot>/merged.log (the startup output of the processes first, then
+# the output of every page in generator order) and their failure reports to
+# shards/<bot>/report.tmp. Every process has a pywikibot directory of its
+# own (user-config.py and cookie jar, pywikibot writes to its jar), the
+# jars are copies of the one in the session cache of login-hack.py.
+@task
+def shard(ctx, bot='simple', generator=None, shards=0, mock=False,
+          yes=False, quiet=False):
+    count = int(shards) or multiprocessing.cpu_count()
+    path = os.path.join(SHARDS, bot)
+    parts = [os.path.join(path, "shard-{0:02d}".format(i))
+             for i in range(count)]
+    config = MOCK_WIKI if mock else '.'
+    job = [
+        "rm -rf {0!s} && mkdir -p {0!s}".format(path),
+        Step("{{wiki!s}} python shard-pages.py --shards {0:d} --output {1!s} "
+             "-- {2!s}".format(count, path, generator or BOTS[bot][1]),
+             name='pages'),
+    ]
+    for part in parts:
+        pwb = os.path.abspath(part + '-pywikibot')
+        setup = "mkdir -p {0!s} && cp {1!s} {0!s}/".format(
+            pwb, os.path.join(config, 'user-config.py'))
+        if not mock:                # mock-wiki accepts any login
+            setup += " && python login-hack.py --copy {0!s}/pywikibot.lwp " \
+                     "$PYWIKIBOT_TOKEN".format(pwb)
+        cmd = "env PYWIKIBOT2_DIR={0!s} PYWIKIBOT_DIR={0!s} {1!s}".format(
+            pwb, botcmd(bot, "-file:" + part + '.txt'))
+        job += [
+            Step(setup, name=pwb, after=('pages',)),
+            Step(cmd, after=('pages', pwb), log=part + '.log.gz',
+                 report=part + '.tmp'),
+        ]
+    try:
+        run(ctx, job, yes=yes, jobs=count, mock=mock, quiet=quiet)
+    finally:                        # the output of failed shards too
+        if plan is None and os.path.exists(os.path.join(path, 'order.txt')):
+            merge(path, parts)
+
+
+# Merge the logs and failure reports of the shards (paths without
+# extension) in the order of order.txt in 'path', output after the last
+# page of a shard stays with that page; shards that did not run are missing
+def merge(path, parts):
+    with io.open(os.path.join(path, 'order.txt'), encoding='utf-8') as f:
+        order = [line.rstrip('\n') for line in f]
+    pages, startup = collections.OrderedDict(), []
+    parts = [part for part in parts if os.path.exists(part + '.log.gz')]
+    for part in parts:
+        with gzip.open(part + '.log.gz', 'rb') as f:
+            lines = f.read().decode('utf-8', 'replace').splitlines()
+        startup.append("=== {0!s} ===".format(os.path.basename(part)))
+        title = None
+        for line in lines:
+            match = PAGE.match(ANSI.sub('', line).strip())
+            if match:
+                title = match.group(1)
+            (pages.setdefault(title, []) if title else startup).append(line)
+    known = set(order)
+    titles = order + [t for t in pages if t not in known]
+    with io.open(os.path.join(path, 'merged.log'), 'w',
+                 encoding='utf-8') as f:
+        for line in startup + [line for title in titles
+                               for line in pages.get(title, [])]:
+            f.write(line + "\n")
+    with open(os.path.join(path, 'report.tmp'), 'w') as f:
+        for part in parts:
+            with open(part + '.tmp') as report:
+                f.write(report.read())
+    logging.info("Merged the output of {0:d} pages ({1:d} without any) of "
+                 "{2:d} shards to {3!s}".format(
+                     len(titles), len([t for t in order if t not in pages]),
+                     len(parts), os.path.join(path, 'merged.log')))
+
+
+# Tune the throughput settings of user-config.py (TUNING) for bulk runs: the
+# bots process 'limit' files from mock-wiki.py ('latency', 'jitter',
+# 'errors' and 'lag' model the server) with every candidate value of one
+# setting after the other, keeping the best values so far (coordinate
+# descent). A candidate has to process all files and be more than 'noise'
+# faster (files/min) to win. All trials with files/min and error rates go
+# to tune/summary.json, user-config.py with the best values to 'output'.
+@task
+def tune(ctx, limit=100, bots='log,simple', latency=0.05, jitter=0.0,
+         errors=0.0, lag=0.0, noise=0.05, output='user-config-bulk.py',
+         yes=False, quiet=False):
+    record = os.path.join(TUNE, 'requests.jsonl')
+    job = ["rm -rf {0!s} && mkdir -p {0!s}".format(TUNE)] + \
+        serving(int(limit), None, latency, jitter, record, errors, lag)
+    run(ctx, job, yes=yes, quiet=quiet)
+    if plan is not None:            # the trials depend on the results
+        return
+    best = collections.OrderedDict((k, v[0]) for (k, v) in TUNING.items())
+    trials = []
+    try:
+        score = trial(ctx, best, bots.split(','), int(limit), record, trials,
+                      quiet)
+        for (name, values) in TUNING.items():
+            for value in values[1:]:
+                candidate = collections.OrderedDict(best)
+                candidate[name] = value
+                result = trial(ctx, candidate, bots.split(','), int(limit),
+                               record, trials, quiet)
+                if result is not None and (
+                        score is None or result > score * (1 + float(noise))):
+                    best, score = candidate, result
+    finally:
+        run(ctx, serving(), yes=yes, quiet=quiet)
+    with open(os.path.join(TUNE, 'summary.json'), 'w') as f:
+        json.dump({'best': best, 'score': score, 'trials': trials}, f,
+                  indent=4)
+    with open('user-config.py') as f:
+        config = f.read()
+    for (name, value) in best.items():
+        config = re.sub(r"(?m)^{0!s} = .*$".format(name),
+                        "{0!s} = {1!r}  # tuned".format(name, value), config)
+    with open(output, 'w') as f:
+        f.write(config)
+    separator(blank=True)
+    logging.info("{0!s} files/min with {1!s}, written to {2!s}".format(
+        "{0:.1f}".format(score) if score is not None else "no",
+        json.dumps(best), output))
+    separator()
+
+
+# One tuning trial: the bots run with 'settings' appended to the generated
+# user-config.py of mock-wiki.py (in a directory of their own), returns the
+# files/min or None if a bot failed or did not process all files
+def trial(ctx, settings, bots, limit, record, trials, quiet):
+    path = os.path.join(TUNE, "{0:03d}".format(len(trials) + 1))
+    os.makedirs(path)
+    with open(os.path.join(MOCK_WIKI, 'user-config.py')) as f:
+        config = f.read()
+    with open(os.path.join(path, 'user-config.py'), 'w') as f:
+        f.write(config + "".join("{0!s} = {1!r}\n".format(k, v)
+                                 for (k, v) in settings.items()))
+    job = ["env PYWIKIBOT2_DIR={0!s} PYWIKIBOT_DIR={0!s} python "
+           "profile-run.py --no-profile --output {1!s} -- {2!s} "
+           "-limit:{3:d}".format(
+               os.path.abspath(path), os.path.join(path, name), botcmd(name),
+               limit) for name in bots]
+    try:
+        run(ctx, job, yes=True, quiet=quiet)
+    except Failure:
+        pass                        # not all bots ran, no score
+    requests = recorded(record)
+    runs = dict((name, observe(os.path.join(path, name), requests))
+                for name in bots
+                if os.path.exists(os.path.join(path, name, 'summary.json')))
+    entry = {'settings': settings, 'score': None, 'runs': dict(
+        (name, {'exit': r['exit'], 'wall': r['wall'],
+                'files': len(r['files']), 'requests': r['requests'],
+                'errors': r['errors'],
+                'error_rate': r['errors'] / (r['requests'] or 1)})
+        for (name, r) in runs.items())}
+    if len(runs) == len(bots) and all(
+            r['exit'] == 0 and len(r['files']) >= limit
+            for r in runs.values()):
+        entry['score'] = 60 * sum(len(r['files']) for r in runs.values()) \
+            / sum(r['wall'] for r in runs.values())
+    trials.append(entry)
+    logging.info("Trial {0:d}: {1!s} files/min, {2:d} errors in {3:d} "
+                 "requests with {4!s}".format(
+                     len(trials), "{0:.1f}".format(entry['score'])
+                     if entry['score'] is not None else "failed, no",
+                     sum(r['errors'] for r in runs.values()),
+                     sum(r['requests'] for r in runs.values()),
+                     json.dumps(settings)))
+    return entry['score']
+
+
+# Plan all given tasks (comma separated) first, coalesce their package
+# installs and then execute them
+@task
+def provision(ctx, names, yes=False, git=False, jobs=1, resume=False,
+              force=False, quiet=False):
+    planned = collect(ctx, names.split(','), yes=yes, git=git, jobs=jobs,
+                      resume=resume, force=True, quiet=quiet)
+    index = [(n, i) for (n, item) in enumerate(planned)
+             for i in range(len(item[1]))]
+    steps = [step for item in planned for step in item[1]]
+    for (i, target) in coalesce(steps).items():
+        (n, j), (m, k) = index[i], index[target]
+        steps[i].skip = "merged into {0!s} step {1:d}".format(
+            planned[m][0], k + 1)
+        steps[i].merged = True
+        if n == m:
+            planned[n][2][j].add(k)
+    for (taskname, steps, deps, kwargs, tasks) in planned:
+        for step in steps:
+            step.key = fingerprint(step, taskname, kwargs)
+    if not force:
+        probe(ctx, [step for item in planned for step in item[1]])
+    for (taskname, steps, deps, kwargs, tasks) in planned:
+        with reporting(kwargs['errors']), journaled(taskname):
+            process(ctx, steps, deps, kwargs, tasks)
+
+
+# Run the install variants (each followed by install_pywikibot and
+# test_script) at the same time, every one in its own directory and
+# virtualenv below matrix/ (spm with the system site-packages as it installs
+# through apt). The git mirrors, the wheelhouse and the compiler cache are
+# shared (clones only hardlink, the others are safe for concurrent use) as
+# is the login session cache, apt-get/dpkg calls are serialized across the
+# variants. Exit status and wall time of every variant are summarized in
+# matrix/summary.json.
+@task
+def matrix(ctx, variants='spm,pip,git', yes=False, quiet=False):
+    names = variants.split(',')
+    shared = [os.path.abspath(path) for path in (MIRRORS, 'wheelhouse', CCACHE)
+              if os.path.exists(path)]
+    job = [
+        Step("sudo apt-get {yes!s} install python-virtualenv",
+             name='virtualenv'),
     ]
-    run(ctx, job, yes=yes, git=git)
+    commands = collections.OrderedDict()
+    for name in names:
+        path = os.path.join(MATRIX, name)
+        # the status is kept, a failing variant must not stop the others
+        commands[name] = (
+            "cd {0!s} && PATH=$PWD/env/bin:$PATH PYWIKIBOT_SESSIONS={3!s} "
+            "invoke install_file_metadata_{1!s} --yes install_pywikibot "
+            "--yes test_script --yes{2!s}; echo $? > status".format(
+                path, name, " --git" if name == 'git' else "",
+                os.path.abspath(SESSIONS)))
+        job += [
+            Step("rm -rf {0!s} && mkdir -p {0!s} && "
+                 "cp -p *.py pywikibot.lwp.hack {0!s}/".format(path),
+                 after=('virtualenv',)),
+            "virtualenv {1!s}{0!s}/env && {0!s}/env/bin/pip install "
+              "invoke".format(path, "--system-site-packages "
+                              if name == 'spm' else ""),
+        ] + ["ln -s {0!s} {1!s}/".format(p, path) for p in shared] + [
+            commands[name],
+        ]
+    run(ctx, job, yes=yes, jobs=len(job), quiet=quiet)
+    if plan is None:
+        summarize(commands)
+
+
+# Exit status and wall time of the variants (name: command) of this run
+def summarize(commands):
+    walls = dict((e['cmd'], e['wall']) for e in traced()
+                 if e['run'] == runid)
+    summary = collections.OrderedDict()
+    for (name, cmd) in commands.items():
+        status = os.path.join(MATRIX, name, 'status')
+        summary[name] = {'exit': None, 'wall': walls.get(cmd)}
+        if os.path.exists(status):
+            with open(status) as f:
+                summary[name]['exit'] = int(f.read())
+    with open(os.path.join(MATRIX, 'summary.json'), 'w') as f:
+        json.dump(summary, f, indent=4)
+    separator(blank=True)
+    for (name, result) in summary.items():
+        logging.info("{0!s:>6} : exit {1!s} in {2:.1f}s".format(
+            name, result['exit'], result['wall'] or 0))
+    separator()
+    if any(result['exit'] != 0 for result in summary.values()):
+        sys.exit(1)
+
+
+# Export the traced steps of the last runs in Chrome trace-event format,
+# view the timeline with chrome://tracing or https://ui.perfetto.dev
+@task
+def trace(ctx, output='trace.json', runs=1):
+    entries = traced()
+    order = sorted(set(e['run'] for e in entries),
+                   key=lambda r: min(e['start'] for e in entries
+                                     if e['run'] == r))[-int(runs):]
+    lanes = {}
+    events = []
+    for entry in entries:
+        if entry['run'] not in order:
+            continue
+        pid = order.index(entry['run']) + 1
+        tid = lanes.setdefault((pid, entry['thread']), len(lanes) + 1)
+        events.append({
+            'name': entry['cmd'][:80], 'cat': entry['task'], 'ph': 'X',
+            'ts': int(entry['start'] * 1e6), 'dur': int(entry['wall'] * 1e6),
+            'pid': pid, 'tid': tid,
+            'args': dict((k, entry[k]) for k in ('step', 'cmd', 'tasks',
+                         'exit', 'utime', 'stime', 'maxrss')),
+        })
+    with open(output, 'w') as f:
+        json.dump({'traceEvents': events, 'displayTimeUnit': 'ms'}, f)
+    logging.info("Exported {0:d} steps of {1:d} run(s) to {2!s}".format(
+        len(events), len(order), output))
+
+
+# Estimate a run of the given tasks (comma separated) from the trace of the
+# past runs without executing anything: the formatted steps with expected
+# wall time and peak RSS (of the process tree of the step), the critical
+# path (marked '*') and the totals for serial execution and for --jobs
+# parallel steps (tasks run one after the other)
+@task
+def estimate(ctx, names, git=False, jobs=4, resume=False, force=False):
+    planned = collect(ctx, names.split(','), yes=True, git=git, jobs=jobs,
+                      resume=resume, force=True)
+    if not force:
+        probe(ctx, [step for item in planned for step in item[1]])
+    model = costs()
+    totals = collections.Counter()
+    for (taskname, steps, deps, kwargs, tasks) in planned:
+        cost = [((0.0, 0) if step.skip else
+                 model.get((taskname, step.cmd), (None, None)))
+                for step in steps]
+        durations = [wall or 0.0 for (wall, maxrss) in cost]
+        earliest = simulate(steps, deps, durations)
+        path = critical(deps, earliest)
+        separator(blank=True)
+        logging.info("> {0!s}".format(taskname))
+        for (i, step) in enumerate(steps):
+            logging.info("{0!s} {1:3d} {2!s:>8} {3!s:>9} {4!s}{5!s}".format(
+                '*' if i in path else ' ', i + 1,
+                "?" if cost[i][0] is None else
+                "{0:.1f}s".format(cost[i][0]),
+                "?" if cost[i][1] is None else
+                "{0:.0f}MiB".format(cost[i][1] / 1024), step.cmd[:80],
+                " ({0!s})".format(step.skip) if step.skip else ""))
+        totals['serial'] += sum(durations)
+        totals['parallel'] += max([0.0] + list(
+            simulate(steps, deps, durations, jobs).values()))
+        totals['critical'] += max([0.0] + list(earliest.values()))
+        totals['unknown'] += sum(1 for c in cost if c[0] is None)
+        totals['maxrss'] = max([totals['maxrss']] + [c[1] or 0 for c in cost])
+    separator(blank=True)
+    logging.info("serial {0:.1f}s, {1:d} jobs {2:.1f}s, critical path "
+                 "{3:.1f}s, peak RSS {4:.0f}MiB, {5:d} step(s) without "
+                 "history".format(totals['serial'], int(jobs),
+                                  totals['parallel'], totals['critical'],
+                                  totals['maxrss'] / 1024, totals['unknown']))
+    separator()
+
+
+# Cost model from the trace: median wall time and highest peak RSS of the
+# past runs of every (task, command), successful runs preferred
+def costs():
+    runs = {}
+    for entry in traced():
+        runs.setdefault((entry['task'], entry['cmd']), []).append(entry)
+    model = {}
+    for (key, entries) in runs.items():
+        entries = [e for e in entries if e['exit'] == 0] or entries
+        walls = sorted(e['wall'] for e in entries)
+        peaks = [e['maxrss'] for e in entries if e['maxrss'] is not None]
+        model[key] = (walls[len(walls) // 2], max(peaks) if peaks else None)
+    return model
+
+
+# Expected end times of the steps of a task given their durations, with at
+# most 'jobs' steps at a time and the resource locks held (started in order
+# like 'schedule' does), without a limit the earliest possible end times
+def simulate(steps, deps, durations, jobs=None):
+    end, held = {}, {}
+    slots = [0.0] * int(jobs or len(steps) or 1)
+    pending = list(range(len(steps)))
+    while pending:
+        i = [i for i in pending if deps[i] <= set(end)][0]
+        pending.remove(i)
+        slot = slots.index(min(slots))
+        start = max([slots[slot]] + [end[d] for d in deps[i]])
+        if jobs:
+            start = max([start] + [held.get(name, 0.0)
+                                   for name in steps[i].locks])
+        end[i] = slots[slot] = start + durations[i]
+        for name in steps[i].locks:
+            held[name] = end[i]
+    return end
+
+
+# Steps on the longest dependency chain given the earliest end times
+def critical(deps, end):
+    if not end:
+        return []
+    i = max(sorted(end), key=lambda k: end[k])
+    path = [i]
+    while deps[i]:
+        i = max(sorted(deps[i]), key=lambda d: end[d])
+        path.append(i)
+    return path[::-1]
+
+
+# Propose step budgets from the trace: the highest usage of the successful
+# runs of every (task, command) times 'margin', at least 10s and 64MiB (the
+# RSS is the peak of the step's process tree, sampled by budget-run.py for
+# budgeted runs, by 'stream' otherwise); also written to 'output' as JSON
+@task
+def calibrate(ctx, margin=1.5, output='budgets.json'):
+    runs = collections.OrderedDict()
+    for entry in traced():
+        if entry['exit'] == 0:
+            runs.setdefault((entry['task'], entry['cmd']), []).append(entry)
+    budgets = []
+    for ((taskname, cmd), entries) in runs.items():
+        usage = [e.get('usage') or {
+            'rss': (e['maxrss'] or 0) / 1024, 'cpu': e['utime'] + e['stime'],
+            'wall': e['wall']} for e in entries]
+        budget = dict((k, int(math.ceil(max(
+            [u[k] * float(margin) for u in usage] + [minimum]))))
+            for (k, minimum) in (('rss', 64), ('cpu', 10), ('wall', 10)))
+        budgets.append({'task': taskname, 'cmd': cmd, 'budget': budget,
+                        'runs': len(entries)})
+        logging.info("{0!s}: budget={1!s} ({2:d} runs) {3!s}".format(
+            taskname, json.dumps(budget, sort_keys=True), len(entries),
+            cmd[:60]))
+    with open(output, 'w') as f:
+        json.dump(budgets, f, indent=4, sort_keys=True)
 
 
 # Test of THIS invoke script
 @task
-def test_this(ctx, yes=False):
+def test_this(ctx, yes=False, resume=False, from_step=0, force=False,
+              quiet=False):
     job = [
         "sudo apt-get {yes!s} update",
         "sudo apt-get {yes!s} install python-flake8",
@@ -372,7 +2294,10 @@ def test_this(ctx, yes=False):
         # E121 continuation line indentation is not a multiple of four
         "flake8 --verbose --show-source --statistics --benchmark "
           "--max-complexity 10 --ignore=E121,E131,FI "
-          "tasks.py login-hack.py",
+          "tasks.py login-hack.py profile-run.py pytest_resources.py "
+          "budget-run.py mock-wiki.py shard-pages.py log_queue.py "
+          "error_report.py memory-report.py process_tree.py",
         "invoke --list",
     ]
-    run(ctx, job, yes=yes)
+    run(ctx, job, yes=yes, resume=resume, from_step=from_step, force=force,
+        quiet=quiet)
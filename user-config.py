@@ -70,6 +70,27 @@ logfilesize = 1024
 # renamed if the logfile is full. The newest file gets the highest number until
 # some logfiles where deleted.
 logfilecount = 5
+
+
+# write the logfiles (and rotate them) on a background thread, records are
+# dropped rather than delaying the bot if it falls behind (see log_queue.py
+# in the directory the bots are started from, e.g. by tasks.py)
+def _queue_logfiles():
+    import os
+    import sys
+    sys.path.append(os.getcwd())
+    try:
+        import log_queue
+        log_queue.patch(policy='drop')
+    except ImportError:         # not started next to log_queue.py
+        pass
+    finally:
+        del sys.path[-1]
+
+
+_queue_logfiles()
+del _queue_logfiles
+
 # set to 1 (or higher) to generate "informative" messages to terminal
 verbose_output = 0
 # set to True to fetch the pywiki version online